@@ -21,6 +21,10 @@ color = 0
 brightness = 0
 contrast = 0
 sharpness = 0
+metric = 'rgb' # Color distance used to pick bricks: 'rgb', 'de76' or 'de2000' (perceptual, better skin tones)
+brick_stock = {} # Optional, bricks owned per color (e.g. {'H': 500}), the used ones in brick_quantity_log.csv are subtracted
+indexed_preview = False # Write the result previews as palette (P mode) PNGs when the tinted bricks fit in 256 colors
+shading_levels = None # Optional, with indexed_preview: shades the brick is reduced to when they do not (e.g. 16)
 
 #=====================   REPLACE COLORS   =====================#
 
@@ -46,25 +50,30 @@ instructions = os.path.dirname(os.path.dirname(__file__)) + '/instructions'
 def pre_process():       
     image = Image.open(f'{raw_files}/{file_name}')
     print(f'Processing file: {file_name}')
+    limits = lego.available_bricks(brick_stock) if brick_stock else None
     lego.pre_process(image, size=size, out_path=f'{processed_files}/{os.path.splitext(file_name)[0]}.png', 
         effect=effect, palette_mode=palette_mode, factor=factor, color=color, brightness=brightness,
-        contrast=contrast, sharpness=sharpness)
+        contrast=contrast, sharpness=sharpness, metric=metric, limits=limits)
     
 def bulk_pre_process():
         path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'processing_pipeline.csv')
         pipeline = pd.read_csv(path, index_col=0)
         pipeline.fillna(value=0, inplace=True)
         pipeline.iloc[:, 2:] = pipeline.iloc[:, 2:].astype(int)
+        settings, out_paths = [], []
         for file_name in pipeline.index:
-            print(f'Processing file: {file_name}')
-            image = Image.open(f'{raw_files}/{file_name}')
             max_size = pipeline.loc[file_name, 'max_size']
-            size = (max_size, max_size)
-            lego.pre_process(image, size=size, out_path=f'{processed_files}/{os.path.splitext(file_name)[0]}.png', 
-                 effect=pipeline.loc[file_name, 'effect'], palette_mode=pipeline.loc[file_name, 'palette_mode'], 
-                 factor=pipeline.loc[file_name, 'factor'], color=pipeline.loc[file_name, 'color'], 
-                 brightness=pipeline.loc[file_name, 'brightness'],contrast=pipeline.loc[file_name, 'contrast'], 
-                 sharpness=pipeline.loc[file_name, 'sharpness'])
+            settings.append(dict(size=(max_size, max_size), effect=pipeline.loc[file_name, 'effect'],
+                                 palette_mode=pipeline.loc[file_name, 'palette_mode'],
+                                 factor=pipeline.loc[file_name, 'factor'], color=pipeline.loc[file_name, 'color'],
+                                 brightness=pipeline.loc[file_name, 'brightness'],
+                                 contrast=pipeline.loc[file_name, 'contrast'],
+                                 sharpness=pipeline.loc[file_name, 'sharpness']))
+            out_paths.append(f'{processed_files}/{os.path.splitext(file_name)[0]}.png')
+        # the originals are opened one at a time, their thumbnails sharing a palette are quantized together
+        images = (Image.open(f'{raw_files}/{file_name}') for file_name in pipeline.index)
+        print(f'Processing {len(out_paths)} files')
+        lego.pre_process_batch(images, settings, out_paths, metric=metric)
     
 def finalize():        
     for file in os.listdir(processed_files):
@@ -80,17 +89,31 @@ def finalize():
             # Add the png with the instructions to the folder
             lego.instructions(image, palette_mode=palette_mode, out_path=instructions_file_path)
             # Add the preview of the final result to the folder
-            brick_image = Image.open(brick_image_path)
+            brick_image = lego.load_brick(brick_image_path)
             print(f'Creating the final preview for {os.path.splitext(file)[0]}.png')
-            lego.make_lego_image(image, brick_image).save(lego_effect_preview)
+            lego.make_lego_image(image, brick_image, indexed=indexed_preview, shading_levels=shading_levels).save(lego_effect_preview)
             # Add the brick count to the folder
             lego.color_count_printer(image, palette_mode, brick_count_path)
             
 def color_replace():
     path = f'{processed_files}/{os.path.splitext(file_name)[0]}.png'
     image = Image.open(path)
+    previous_image = image.copy()
     print(f'Replacing colors in: {file_name}')
     lego.manual_color_replace(image, colors_to_replace, palette_mode, path)
+    # Patch the replaced bricks into an existing preview of the final result
+    lego_effect_preview = f'{instructions}/{os.path.splitext(file_name)[0]}/Result_preview_{os.path.splitext(file_name)[0]}.png'
+    if os.path.isfile(lego_effect_preview):
+        brick_image_path = os.path.join(os.path.dirname(__file__), 'lego', 'assets', 'bricks', '1x1.png')
+        brick_image = lego.load_brick(brick_image_path)
+        with Image.open(lego_effect_preview) as preview:
+            lego_image = preview.convert('RGB') if preview.mode == 'RGB' else None
+        print(f'Updating the final preview for {os.path.splitext(file_name)[0]}.png')
+        if lego_image is None or indexed_preview:
+            # indexed previews may use shade reduced bricks, they are rendered again to stay consistent
+            lego.make_lego_image(image, brick_image, indexed=indexed_preview, shading_levels=shading_levels).save(lego_effect_preview)
+        else:
+            lego.update_lego_image(lego_image, previous_image, image, brick_image, lego_effect_preview)
     
 def main():
     if pre_process_ == 1:
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.cache
+----------
+
+This module contains the process-wide cache of decoded brick assets and
+tinted brick tiles, so that batch jobs only tint each brick color once, and
+the pool of band buffers reused by consecutive renders.
+
+
+    USAGE:
+    $ lego.cache.bricks.max_bytes = 128 * 1024 * 1024
+    $ lego.cache.bricks.stats()
+    $ with lego.cache.buffers.borrowed((height, width, 3)) as band:
+    $     ...
+
+See README for project details.
+"""
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import threading
+
+import numpy as np
+
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# enough for the band buffers of a render, idle buffers stay resident in every process
+DEFAULT_POOL_BYTES = 16 * 1024 * 1024
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by the memory of its values."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._evict()
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        """Store a value of nbytes, evicting the oldest entries over budget."""
+        with self._lock:
+            if nbytes > self._max_bytes:
+                return value
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+            return value
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the hit/miss counters and the memory in use."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries),
+                    'bytes': self.current_bytes, 'max_bytes': self._max_bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _evict(self):
+        while self.current_bytes > self._max_bytes and self._entries:
+            self.current_bytes -= self._entries.popitem(last=False)[1][1]
+
+
+class BufferPool(object):
+    """Free lists of NumPy arrays keyed by shape and dtype, bounded by the memory they hold."""
+
+    def __init__(self, max_bytes=DEFAULT_POOL_BYTES):
+        self._free = deque()
+        self._lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.reused = 0
+        self.allocated = 0
+
+    def borrow(self, shape, dtype=np.uint8):
+        """Return an uninitialized array, reusing a released one when possible."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            for n, (free_key, array) in enumerate(self._free):
+                if free_key == key:
+                    del self._free[n]
+                    self.current_bytes -= array.nbytes
+                    self.reused += 1
+                    return array
+            self.allocated += 1
+        return np.empty(key[0], dtype=dtype)
+
+    def release(self, array):
+        """Give an array back, dropping the oldest ones over budget."""
+        if array.base is not None or not array.flags.writeable or array.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._free.append(((array.shape, array.dtype.str), array))
+            self.current_bytes += array.nbytes
+            while self.current_bytes > self.max_bytes:
+                self.current_bytes -= self._free.popleft()[1].nbytes
+
+    @contextmanager
+    def borrowed(self, shape, dtype=np.uint8):
+        """Borrow an array for the duration of a with block."""
+        array = self.borrow(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.release(array)
+
+    def clear(self):
+        """Drop every pooled array and reset the counters."""
+        with self._lock:
+            self._free.clear()
+            self.current_bytes = 0
+            self.reused = 0
+            self.allocated = 0
+
+    def stats(self):
+        """Return the reuse counters and the memory held."""
+        with self._lock:
+            return {'reused': self.reused, 'allocated': self.allocated, 'buffers': len(self._free),
+                    'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+
+bricks = LRUCache()
+buffers = BufferPool()
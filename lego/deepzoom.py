@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.deepzoom
+-------------
+
+This module contains a lazy Deep Zoom (DZI) tile pyramid. Tiles are rendered
+on request by a per-level renderer, so an image never needs to exist at full
+resolution and the coarse levels are available almost immediately.
+
+
+    USAGE:
+    $ pyramid = lego.deepzoom.DeepZoomPyramid(width, height, make_renderer)
+    $ pyramid.get_tile(level, column, row)
+    $ pyramid.save('mosaic.dzi', workers=4)
+
+See README for project details.
+"""
+from __future__ import division
+
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import threading
+
+
+DZI_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                'Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">\n'
+                '  <Size Width="{width}" Height="{height}"/>\n'
+                '</Image>\n')
+
+
+class DeepZoomPyramid(object):
+    """Deep Zoom pyramid whose tiles are rendered lazily.
+
+    make_renderer(scale) must return a function that renders a box
+    (left, upper, right, lower), in pixels of the image scaled by scale,
+    as a PIL image of the box size.
+    """
+
+    def __init__(self, width, height, make_renderer, tile_size=254, overlap=1, tile_format='png'):
+        self.width = width
+        self.height = height
+        self.make_renderer = make_renderer
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_format = tile_format
+        self.max_level = int(math.ceil(math.log(max(width, height), 2)))
+        self._renderers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def levels(self):
+        return self.max_level + 1
+
+    def level_scale(self, level):
+        return 0.5 ** (self.max_level - level)
+
+    def level_size(self, level):
+        scale = self.level_scale(level)
+        return (int(math.ceil(self.width * scale)), int(math.ceil(self.height * scale)))
+
+    def tile_count(self, level):
+        width, height = self.level_size(level)
+        return (int(math.ceil(width / self.tile_size)), int(math.ceil(height / self.tile_size)))
+
+    def tile_box(self, level, column, row):
+        """Pixel box of a tile in its level, overlap included."""
+        width, height = self.level_size(level)
+        left = column * self.tile_size - (self.overlap if column else 0)
+        upper = row * self.tile_size - (self.overlap if row else 0)
+        right = min(width, (column + 1) * self.tile_size + self.overlap)
+        lower = min(height, (row + 1) * self.tile_size + self.overlap)
+        return (left, upper, right, lower)
+
+    def get_tile(self, level, column, row):
+        """Render a single tile."""
+        if not 0 <= level <= self.max_level:
+            raise ValueError('The level must be within 0 and {0}.'.format(self.max_level))
+        columns, rows = self.tile_count(level)
+        if not (0 <= column < columns and 0 <= row < rows):
+            raise ValueError('Tile ({0}, {1}) does not exist at level {2}.'.format(column, row, level))
+        return self._get_renderer(level)(self.tile_box(level, column, row))
+
+    def save(self, dzi_path, workers=1):
+        """Write the .dzi descriptor and its _files folder, coarsest level first."""
+        tiles_folder = os.path.splitext(dzi_path)[0] + '_files'
+        with open(dzi_path, 'w') as dzi_file:
+            dzi_file.write(DZI_TEMPLATE.format(format=self.tile_format, overlap=self.overlap,
+                                               tile_size=self.tile_size, width=self.width, height=self.height))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for level in range(self.levels):
+                level_folder = os.path.join(tiles_folder, str(level))
+                if not os.path.exists(level_folder):
+                    os.makedirs(level_folder)
+                columns, rows = self.tile_count(level)
+                tasks = [executor.submit(self._save_tile, level_folder, level, column, row)
+                         for row in range(rows) for column in range(columns)]
+                for task in tasks:
+                    task.result()
+        return tiles_folder
+
+    def _save_tile(self, level_folder, level, column, row):
+        tile_path = os.path.join(level_folder, '{0}_{1}.{2}'.format(column, row, self.tile_format))
+        self.get_tile(level, column, row).save(tile_path)
+
+    def _get_renderer(self, level):
+        with self._lock:
+            if level not in self._renderers:
+                self._renderers[level] = self.make_renderer(self.level_scale(level))
+            return self._renderers[level]
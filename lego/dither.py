@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.dither
+-----------
+
+This module contains the error diffusion engine used to dither images to a
+lego palette with the Floyd-Steinberg, Atkinson or Sierra kernels.
+
+Every pixel only receives error from pixels at most two columns to its right
+in the row above, so all the pixels on a line x + 3 * y = t can be
+quantized at once: each tile is swept by these wavefronts with NumPy.
+Tiles are swept in the same way, a diagonal c + 2 * r at a time, with the
+error carried into the neighbouring tiles through one shared buffer, so the
+tiles of a diagonal can be dithered by several processes. The result only
+depends on the tile size, never on the number of workers.
+
+Every wavefront is a NumPy call of its own, so the sweep is dominated by
+per call overhead and the default tiles span a whole thumbnail (512 pixels):
+a 512x512 image takes about 0.28 s, against 0.66 s with 128 pixel tiles.
+PIL's own Floyd-Steinberg (dither=True in quantize_to_palette) runs in about
+0.01 s and remains the fast default, these kernels are for picking another
+kernel and for results that do not depend on the Pillow version. Smaller
+tiles only pay off when several workers share a large image.
+
+Ordered dithering ('bayer4', 'bayer8' or the bundled 'blue-noise' mask) adds
+a threshold that only depends on the pixel position before looking up the
+nearest color, so still areas of animation frames keep the same bricks and
+any band of an image can be dithered on its own without seams.
+
+
+    USAGE:
+    $ lego.dither.diffuse(pixels, lego.palettes.get_palette('solid'), 'atkinson')
+    $ lego.dither.ordered(pixels, lego.palettes.get_palette('solid'), 'blue-noise')
+
+See README for project details.
+"""
+from __future__ import division
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import os
+
+import numpy as np
+from PIL import Image
+
+from lego import quantize, shared
+
+
+# (divisor, [(row offset, column offset, weight), ...])
+KERNELS = {
+    'floyd-steinberg': (16, [(0, 1, 7),
+                             (1, -1, 3), (1, 0, 5), (1, 1, 1)]),
+    'atkinson': (8, [(0, 1, 1), (0, 2, 1),
+                     (1, -1, 1), (1, 0, 1), (1, 1, 1),
+                     (2, 0, 1)]),
+    'sierra': (32, [(0, 1, 5), (0, 2, 3),
+                    (1, -2, 2), (1, -1, 4), (1, 0, 5), (1, 1, 4), (1, 2, 2),
+                    (2, -1, 2), (2, 0, 3), (2, 1, 2)]),
+    }
+
+# the error buffer is padded so that no kernel reaches outside of it
+PAD = 2
+
+# 64x64 void-and-cluster mask, every gray level is used by 16 pixels
+BLUE_NOISE_PATH = os.path.join(os.path.dirname(__file__), 'assets', 'dither', 'blue_noise_64.png')
+
+
+def get_kernel(name):
+    """Weights of a kernel as (row offset, column offset, float weight) tuples."""
+    if name not in KERNELS:
+        raise ValueError('The dithering kernel must be one of {0}.'.format(', '.join(sorted(KERNELS))))
+    divisor, weights = KERNELS[name]
+    return [(dy, dx, np.float32(weight / divisor)) for dy, dx, weight in weights]
+
+
+@lru_cache(maxsize=16)
+def wavefronts(height, width):
+    """Pixel coordinates of a tile grouped by x + 3 * y, in processing order."""
+    ys, xs = np.mgrid[:height, :width]
+    order = (xs + 3 * ys).ravel()
+    ys, xs = ys.ravel(), xs.ravel()
+    steps = np.argsort(order, kind='stable')
+    bounds = np.flatnonzero(np.diff(order[steps])) + 1
+    return [(ys[step], xs[step]) for step in np.split(steps, bounds)]
+
+
+def diffuse_tile(work, indices, colors, kernel, top, left, height, width):
+    """Quantize one tile of the padded float32 error buffer, writing palette indices."""
+    # flat positions in the error buffer and the indices, the kernel becomes fixed position offsets
+    stride = work.shape[1]
+    pixels, flat_indices = work.reshape(-1, 3), indices.reshape(-1)
+    offsets = [(dy * stride + dx, weight) for dy, dx, weight in kernel]
+    for ys, xs in wavefronts(height, width):
+        ys, xs = ys + top, xs + left
+        positions = ys * stride + xs + PAD
+        values = pixels[positions]
+        # the channels are summed one by one, (n, colors, 3) arrays are slow to reduce over their last axis
+        differences = values[:, None, :] - colors[None, :, :]
+        differences *= differences
+        distances = differences[..., 0] + differences[..., 1] + differences[..., 2]
+        nearest = distances.argmin(axis=1)
+        flat_indices[ys * indices.shape[1] + xs] = nearest
+        error = values - colors[nearest]
+        for offset, weight in offsets:
+            pixels[positions + offset] += weight * error
+
+
+def tile_diagonals(height, width, tile_size):
+    """Tile boxes (top, left, height, width) grouped by c + 2 * r, in processing order."""
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+    diagonals = [[] for _ in range(columns + 2 * (rows - 1))]
+    for row in range(rows):
+        for column in range(columns):
+            top, left = row * tile_size, column * tile_size
+            diagonals[column + 2 * row].append((top, left, min(tile_size, height - top),
+                                                min(tile_size, width - left)))
+    return diagonals
+
+
+_tile_worker = {}
+
+
+def _init_tile_worker(work_spec, indices_spec, colors, kernel):
+    work_shm, work = shared.attach(work_spec)
+    indices_shm, indices = shared.attach(indices_spec)
+    _tile_worker.update(shms=(work_shm, indices_shm), work=work, indices=indices, colors=colors, kernel=kernel)
+
+
+def _diffuse_tile(box):
+    diffuse_tile(_tile_worker['work'], _tile_worker['indices'], _tile_worker['colors'], _tile_worker['kernel'], *box)
+
+
+def diffuse(pixels, palette, kernel='floyd-steinberg', tile_size=512, workers=1):
+    """Dither an (height, width, 3) array to a compiled palette, returns palette indices."""
+    weights = get_kernel(kernel)
+    if tile_size < 2 * PAD:
+        # narrower tiles of one diagonal would spread error onto the same pixels
+        raise ValueError('Tiles must be at least {0} pixels wide.'.format(2 * PAD))
+    pixels = np.asarray(pixels, dtype=np.float32)
+    height, width = pixels.shape[:2]
+    colors = palette.colors.astype(np.float32)
+    shape = (height + PAD, width + 2 * PAD, 3)
+    diagonals = tile_diagonals(height, width, tile_size)
+    if workers <= 1:
+        work = np.zeros(shape, dtype=np.float32)
+        work[:height, PAD:PAD + width] = pixels
+        indices = np.empty((height, width), dtype=np.uint8)
+        for diagonal in diagonals:
+            for box in diagonal:
+                diffuse_tile(work, indices, colors, weights, *box)
+        return indices
+    with shared.SharedArray(shape, np.float32) as work, shared.SharedArray((height, width)) as indices:
+        work.array[:] = 0
+        work.array[:height, PAD:PAD + width] = pixels
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_tile_worker,
+                                 initargs=(work.spec, indices.spec, colors, weights)) as executor:
+            for diagonal in diagonals:
+                list(executor.map(_diffuse_tile, diagonal))
+        return indices.array.copy()
+
+
+def bayer_matrix(size):
+    """Bayer index matrix of a power of two size, values 0 to size ** 2 - 1."""
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2],
+                           [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+def blue_noise_matrix():
+    with Image.open(BLUE_NOISE_PATH) as mask:
+        return np.asarray(mask.convert('L'), dtype=np.int64)
+
+
+@lru_cache(maxsize=None)
+def threshold_map(pattern):
+    """Threshold offsets of a pattern, evenly spread over [-0.5, 0.5)."""
+    if pattern not in PATTERNS:
+        raise ValueError('The dithering pattern must be one of {0}.'.format(', '.join(sorted(PATTERNS))))
+    matrix = PATTERNS[pattern]()
+    levels = matrix.max() + 1
+    thresholds = ((matrix + 0.5) / levels - 0.5).astype(np.float32)
+    thresholds.flags.writeable = False
+    return thresholds
+
+
+def palette_spread(palette):
+    """Median distance from each palette color to its nearest other color, per channel."""
+    if len(palette) < 2:
+        return 0.0
+    colors = palette.colors.astype(np.float32)
+    distances = np.sqrt(((colors[:, None, :] - colors[None, :, :]) ** 2).sum(axis=2))
+    np.fill_diagonal(distances, np.inf)
+    return float(np.median(distances.min(axis=1)) / np.sqrt(3))
+
+
+def ordered_band(pixels, palette, thresholds, spread, top=0, left=0):
+    """Ordered dither of an (height, width, 3) band whose first pixel is at (top, left)."""
+    height, width = pixels.shape[:2]
+    rows = (np.arange(top, top + height) % thresholds.shape[0])[:, None]
+    columns = (np.arange(left, left + width) % thresholds.shape[1])[None, :]
+    offsets = thresholds[rows, columns][..., None] * spread
+    dithered = np.clip(pixels + offsets, 0, 255).astype(np.uint8)
+    return quantize.quantize_array(dithered, palette)
+
+
+def ordered(pixels, palette, pattern='bayer8', spread=None, band_height=64, workers=1):
+    """Dither an (height, width, 3) array to a compiled palette with a threshold
+    pattern, returns palette indices. spread scales the thresholds and defaults to
+    the distance between neighbouring palette colors."""
+    thresholds = threshold_map(pattern)
+    if spread is None:
+        spread = palette_spread(palette)
+    pixels = np.asarray(pixels, dtype=np.float32)
+    height = pixels.shape[0]
+    if workers <= 1:
+        return ordered_band(pixels, palette, thresholds, spread)
+    indices = np.empty(pixels.shape[:2], dtype=np.uint8)
+    # build the table the bands quantize with (gray palettes use their own) once, before the threads share it
+    quantize.quantize_array(np.zeros((1, 3), dtype=np.uint8), palette)
+
+    def dither_band(top):
+        indices[top:top + band_height] = ordered_band(pixels[top:top + band_height], palette,
+                                                      thresholds, spread, top)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(dither_band, range(0, height, band_height)))
+    return indices
+
+
+PATTERNS = {
+    'bayer4': lambda: bayer_matrix(4),
+    'bayer8': lambda: bayer_matrix(8),
+    'blue-noise': blue_noise_matrix,
+    }
@@ -12,11 +12,15 @@ Color mapping source;
 
     USAGE:
     $ legofy.palettes.legos
+    $ legofy.palettes.get_palette('solid')
 
 See README for project details.
 """
 from __future__ import division
 
+import numpy as np
+from PIL import Image
+
 
 LEGOS = {
     'bw': {
@@ -130,3 +134,61 @@ def _merge_palettes(palettes):
             unified.update({item: palettes[palette][item]})
     palettes.update({'all': unified})
     return palettes
+
+
+class Palette(object):
+    """Lego palette compiled once by get_palette and shared by every caller."""
+
+    __slots__ = ('name', 'letters', 'colors', 'flat', 'image', 'letter_index', 'lookups')
+
+    def __init__(self, name, mapping):
+        self.name = name
+        self.letters = tuple(mapping)
+        self.colors = np.array([mapping[letter] for letter in self.letters], dtype=np.uint8)
+        self.colors.flags.writeable = False
+        self.flat = tuple(extend_palette([i for letter in self.letters for i in mapping[letter]]))
+        self.image = Image.new('P', (1, 1))
+        self.image.putpalette(self.flat)
+        self.letter_index = dict((letter, n) for n, letter in enumerate(self.letters))
+        # structures derived from the palette by other modules, built on first use
+        self.lookups = {}
+
+    def __len__(self):
+        return len(self.letters)
+
+    def __repr__(self):
+        return 'Palette({0!r}, {1} colors)'.format(self.name, len(self))
+
+    def index(self, letter):
+        """Palette index of a color letter."""
+        try:
+            return self.letter_index[letter]
+        except KeyError:
+            raise ValueError('Color {0} is not in the {1} palette.'.format(letter, self.name))
+
+    def replacement_map(self, replacements):
+        """Index to index lookup array applying a {old letter: new letter} mapping."""
+        mapping = np.arange(256, dtype=np.uint8)
+        for old, new in replacements.items():
+            if old in self.letter_index:
+                mapping[self.letter_index[old]] = self.index(new)
+        return mapping
+
+    def limit_array(self, limits):
+        """Per index brick limits from a {letter: bricks} mapping, unlimited for the other colors."""
+        array = np.full(len(self), np.inf)
+        for letter, bricks in limits.items():
+            if letter in self.letter_index:
+                array[self.letter_index[letter]] = max(bricks, 0)
+        return array
+
+
+_compiled = {}
+
+
+def get_palette(name):
+    """Return the compiled palette for name, building it on first use."""
+    palette = _compiled.get(name)
+    if palette is None:
+        palette = _compiled.setdefault(name, Palette(name, _merge_palettes(LEGOS.copy())[name]))
+    return palette
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.quantize
+-------------
+
+This module contains the NumPy quantization engines that map RGB pixels to
+the index of their nearest color in a compiled lego palette.
+
+The 3D lookup tables are built once per palette and bit depth, kept on the
+palette and cached on disk (in $LEGO_CACHE_DIR, ~/.cache/lego by default)
+under a name derived from the palette colors. A 6 bit table sampled at the
+origin of each cell maps colors exactly like PIL's palette conversion.
+
+Distances are measured with one of the METRICS: 'rgb' (Euclidean RGB, as
+PIL does), 'de76' (Euclidean CIELAB) or 'de2000' (CIEDE2000). Lab tables are
+sampled at the center of each cell, so every metric costs a single lookup.
+
+Palettes made only of grays, like 'bw', skip the 3D tables: their nearest
+color follows from one value per pixel, the channel sum or L*.
+
+
+    USAGE:
+    $ lego.quantize.quantize_array(pixels, lego.palettes.get_palette('solid'))
+    $ lego.quantize.quantize_palettes(pixels, [lego.palettes.get_palette(name) for name in ('art', 'solid')])
+    $ lego.quantize.quantize_batch(thumbnails, lego.palettes.get_palette('solid'))
+
+See README for project details.
+"""
+from __future__ import division
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+LUT_VERSION = 1
+CHUNK_SIZE = 1 << 16
+
+SRGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def get_cache_dir():
+    """Folder for the lookup tables cached on disk."""
+    return os.environ.get('LEGO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'lego'))
+
+
+def palette_hash(palette):
+    """Hash of the palette colors, versioning every structure derived from them."""
+    digest = hashlib.sha1('v{0}'.format(LUT_VERSION).encode('ascii'))
+    digest.update(np.ascontiguousarray(palette.colors).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def rgb_to_lab(pixels):
+    """CIELAB (D65) coordinates of an (..., 3) array of sRGB colors."""
+    rgb = np.asarray(pixels, dtype=np.float64) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = np.dot(linear, SRGB_TO_XYZ.T) / D65_WHITE
+    delta = 6 / 29
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def delta_e76(lab, palette_lab):
+    """Squared CIE76 distances between (n, 3) Lab colors and (m, 3) palette colors."""
+    return ((lab[:, None, :] - palette_lab[None, :, :]) ** 2).sum(axis=2)
+
+
+def delta_e2000(lab, palette_lab):
+    """CIEDE2000 distances between (n, 3) Lab colors and (m, 3) palette colors."""
+    L1, a1, b1 = [lab[:, None, channel] for channel in range(3)]
+    L2, a2, b2 = [palette_lab[None, :, channel] for channel in range(3)]
+    C1, C2 = np.hypot(a1, b1), np.hypot(a2, b2)
+    C_mean7 = ((C1 + C2) / 2) ** 7
+    G = 0.5 * (1 - np.sqrt(C_mean7 / (C_mean7 + 25.0 ** 7)))
+    a1, a2 = a1 * (1 + G), a2 * (1 + G)
+    C1, C2 = np.hypot(a1, b1), np.hypot(a2, b2)
+    h1 = np.degrees(np.arctan2(b1, a1)) % 360
+    h2 = np.degrees(np.arctan2(b2, a2)) % 360
+    chroma = (C1 * C2) != 0
+    dh = h2 - h1
+    dh = np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh)) * chroma
+    dL, dC = L2 - L1, C2 - C1
+    dH = 2 * np.sqrt(C1 * C2) * np.sin(np.radians(dh / 2))
+    L_mean, C_mean = (L1 + L2) / 2, (C1 + C2) / 2
+    h_sum = h1 + h2
+    h_mean = np.where(np.abs(h1 - h2) <= 180, h_sum / 2,
+                      np.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2))
+    h_mean = np.where(chroma, h_mean, h_sum)
+    T = (1 - 0.17 * np.cos(np.radians(h_mean - 30)) + 0.24 * np.cos(np.radians(2 * h_mean))
+         + 0.32 * np.cos(np.radians(3 * h_mean + 6)) - 0.20 * np.cos(np.radians(4 * h_mean - 63)))
+    S_L = 1 + 0.015 * (L_mean - 50) ** 2 / np.sqrt(20 + (L_mean - 50) ** 2)
+    S_C = 1 + 0.045 * C_mean
+    S_H = 1 + 0.015 * C_mean * T
+    C_mean7 = C_mean ** 7
+    R_T = (-2 * np.sqrt(C_mean7 / (C_mean7 + 25.0 ** 7))
+           * np.sin(np.radians(60 * np.exp(-((h_mean - 275) / 25) ** 2))))
+    return np.sqrt((dL / S_L) ** 2 + (dC / S_C) ** 2 + (dH / S_H) ** 2 + R_T * (dC / S_C) * (dH / S_H))
+
+
+def union_colors(palettes):
+    """Distinct colors of several palettes, and the column of every palette color among them."""
+    stacked = np.concatenate([palette.colors for palette in palettes])
+    colors, inverse = np.unique(stacked, axis=0, return_inverse=True)
+    bounds = np.cumsum([len(palette) for palette in palettes])[:-1]
+    return colors, np.split(inverse.ravel(), bounds)
+
+
+def nearest_indices_multi(pixels, palettes, metric='rgb'):
+    """Exact nearest index in each of several palettes of an (..., 3) array of pixels.
+    Distances to the union of the palette colors are measured once, each palette then
+    takes the argmin over its own columns."""
+    if metric not in METRICS:
+        raise ValueError('The metric must be one of {0}.'.format(', '.join(METRICS)))
+    pixels = np.asarray(pixels)
+    flat = pixels.reshape(-1, 3)
+    colors, columns = union_colors(palettes)
+    if metric == 'rgb':
+        flat, colors, distance = flat.astype(np.int32), colors.astype(np.int32), delta_e76
+    else:
+        colors, distance = rgb_to_lab(colors), METRICS[metric]
+    indices = [np.empty(len(flat), dtype=np.uint8) for _ in palettes]
+    for start in range(0, len(flat), CHUNK_SIZE):
+        chunk = flat[start:start + CHUNK_SIZE]
+        if metric != 'rgb':
+            chunk = rgb_to_lab(chunk)
+        distances = distance(chunk, colors)
+        for palette_indices, palette_columns in zip(indices, columns):
+            palette_indices[start:start + CHUNK_SIZE] = distances[:, palette_columns].argmin(axis=1)
+    return [palette_indices.reshape(pixels.shape[:-1]) for palette_indices in indices]
+
+
+def nearest_indices(pixels, palette, metric='rgb'):
+    """Exact nearest palette index of an (..., 3) array of pixels under metric."""
+    return nearest_indices_multi(pixels, [palette], metric)[0]
+
+
+def _cached_array(palette, name, build):
+    """Palette lookup kept on the palette and on disk, built on first use."""
+    if name in palette.lookups:
+        return palette.lookups[name]
+    path = os.path.join(get_cache_dir(), '{0}_{1}.npy'.format(name, palette_hash(palette)))
+    try:
+        array = np.load(path)
+    except (IOError, OSError, ValueError):
+        array = build()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy')
+            with os.fdopen(handle, 'wb') as temp_file:
+                np.save(temp_file, array)
+            os.replace(temp_path, path)
+        except (IOError, OSError):
+            # the disk cache is an optimization only, read-only homes still work
+            pass
+    array.flags.writeable = False
+    palette.lookups[name] = array
+    return array
+
+
+def lookup_name(name, bits, metric):
+    return '{0}{1}'.format(name, bits) if metric == 'rgb' else '{0}{1}_{2}'.format(name, bits, metric)
+
+
+def color_lookup_table(palette, bits=6, metric='rgb'):
+    """(2**bits,) * 3 table of the palette index of every cell of the RGB cube,
+    sampled at the origin of the cell for 'rgb' and at its center otherwise."""
+    def build():
+        levels = np.arange(1 << bits, dtype=np.uint8) << (8 - bits)
+        if metric != 'rgb' and bits < 8:
+            levels += 1 << (7 - bits)
+        cube = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1)
+        return nearest_indices(cube, palette, metric)
+    return _cached_array(palette, lookup_name('lut', bits, metric), build)
+
+
+def ambiguous_cells(palette, bits=6, metric='rgb'):
+    """Cells of the lookup table whose pixels do not all share one nearest color.
+
+    RGB nearest color regions are convex, so a cell whose eight corners agree
+    maps every pixel inside it to that color. Lab regions are only nearly
+    convex in RGB, which makes the test a close approximation there."""
+    def build():
+        step = 1 << (8 - bits)
+        levels = np.arange(1 << bits) * step
+        corners = np.stack([levels, levels + step - 1], axis=1).ravel().astype(np.uint8)
+        cube = np.stack(np.meshgrid(corners, corners, corners, indexing='ij'), axis=-1)
+        nearest = nearest_indices(cube, palette, metric).reshape((1 << bits, 2) * 3)
+        nearest = nearest.transpose(0, 2, 4, 1, 3, 5).reshape((1 << bits,) * 3 + (8,))
+        ambiguous = (nearest != nearest[..., :1]).any(axis=-1)
+        if metric != 'rgb':
+            # center sampled tables disagree with the corners wherever a boundary crosses the cell
+            ambiguous |= nearest[..., 0] != color_lookup_table(palette, bits, metric)
+        return ambiguous
+    return _cached_array(palette, lookup_name('ambiguous', bits, metric), build)
+
+
+def lookup_cells(pixels, bits=6):
+    """Flat lookup table cell of every pixel of an (..., 3) uint8 array."""
+    shift = 8 - bits
+    cells = (pixels[..., 0] >> shift).astype(np.intp)
+    cells <<= bits
+    cells |= pixels[..., 1] >> shift
+    cells <<= bits
+    cells |= pixels[..., 2] >> shift
+    return cells
+
+
+def gray_levels(palette):
+    """Levels of a palette made only of grays, or None."""
+    colors = palette.colors
+    if (colors == colors[:, :1]).all():
+        return colors[:, 0]
+    return None
+
+
+def rgb_to_lightness(pixels):
+    """CIELAB L* of an (..., 3) array of sRGB colors, through per channel tables."""
+    ramp = np.arange(256) / 255
+    linear = np.where(ramp <= 0.04045, ramp / 12.92, ((ramp + 0.055) / 1.055) ** 2.4)
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    luminance = sum(np.take(linear * SRGB_TO_XYZ[1, channel], pixels[..., channel]) for channel in range(3))
+    delta = 6 / 29
+    return 116 * np.where(luminance > delta ** 3, np.cbrt(luminance), luminance / (3 * delta ** 2) + 4 / 29) - 16
+
+
+def gray_sum_table(palette, shift):
+    """Palette index of every channel sum of pixels shifted right by shift bits.
+
+    For a gray g, the squared RGB distance |c - g|^2 = |c|^2 + 3 g^2 - 2 g (r + g + b),
+    so the nearest gray of a pixel only depends on the sum of its channels."""
+    name = 'graysum{0}'.format(shift)
+    if name not in palette.lookups:
+        sums = np.arange(3 * (255 >> shift) + 1, dtype=np.int64) << shift
+        levels = gray_levels(palette).astype(np.int64)
+        table = (3 * levels[None, :] ** 2 - 2 * levels[None, :] * sums[:, None]).argmin(axis=1).astype(np.uint8)
+        table.flags.writeable = False
+        palette.lookups[name] = table
+    return palette.lookups[name]
+
+
+def quantize_gray(pixels, palette, bits=6, refine=False, metric='rgb'):
+    """Palette indices of an (..., 3) uint8 array for a palette of grays. One value per
+    pixel decides its nearest gray and is digitized against the palette levels: the
+    channel sum for 'rgb', looked up at the lookup table cell origins like
+    quantize_array unless refine is set, or L* for 'de76', always exact."""
+    levels = gray_levels(palette)
+    if levels is None or metric not in ('rgb', 'de76'):
+        raise ValueError('Gray quantization needs a palette of grays and the rgb or de76 metric.')
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    if metric == 'de76':
+        lightness = rgb_to_lightness(levels[:, None].repeat(3, axis=1))
+        order = np.argsort(lightness, kind='stable')
+        bounds = (lightness[order][1:] + lightness[order][:-1]) / 2
+        return order[np.searchsorted(bounds, rgb_to_lightness(pixels))].astype(np.uint8)
+    shift = 0 if refine else 8 - bits
+    sums = (pixels[..., 0] >> shift).astype(np.uint16)
+    sums += pixels[..., 1] >> shift
+    sums += pixels[..., 2] >> shift
+    return np.take(gray_sum_table(palette, shift), sums)
+
+
+def quantize_palettes(pixels, palettes, bits=6, refine=False, metric='rgb'):
+    """Palette indices of an (..., 3) uint8 array in each of several palettes, in one
+    pass: the lookup cells are found once and the refined pixels of every palette
+    share one distance computation."""
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    cells = lookup_cells(pixels, bits)
+    indices = [np.take(color_lookup_table(palette, bits, metric).ravel(), cells) for palette in palettes]
+    if refine:
+        ambiguous = np.zeros(cells.shape, dtype=bool)
+        for palette in palettes:
+            ambiguous |= np.take(ambiguous_cells(palette, bits, metric).ravel(), cells)
+        if ambiguous.any():
+            exact = nearest_indices_multi(pixels[ambiguous], palettes, metric)
+            for palette_indices, palette_exact in zip(indices, exact):
+                palette_indices[ambiguous] = palette_exact
+    return indices
+
+
+def quantize_array(pixels, palette, bits=6, refine=False, metric='rgb'):
+    """Palette indices of an (..., 3) uint8 array through the lookup table. With
+    refine, pixels in ambiguous cells get their exact nearest color. Palettes of
+    grays take the one dimensional quantize_gray path instead."""
+    if metric in ('rgb', 'de76') and gray_levels(palette) is not None:
+        return quantize_gray(pixels, palette, bits, refine, metric)
+    return quantize_palettes(pixels, [palette], bits, refine, metric)[0]
+
+
+def palette_costs(pixels, palette, metric='rgb'):
+    """(n, len(palette)) color distances of the pixels of an (..., 3) array under metric."""
+    if metric not in METRICS:
+        raise ValueError('The metric must be one of {0}.'.format(', '.join(METRICS)))
+    flat = np.asarray(pixels).reshape(-1, 3)
+    if metric == 'rgb':
+        flat, colors = flat.astype(np.int32), palette.colors.astype(np.int32)
+    else:
+        colors = rgb_to_lab(palette.colors)
+    costs = np.empty((len(flat), len(palette)), dtype=np.float32)
+    for start in range(0, len(flat), CHUNK_SIZE):
+        chunk = flat[start:start + CHUNK_SIZE]
+        if metric != 'rgb':
+            chunk = rgb_to_lab(chunk)
+        costs[start:start + CHUNK_SIZE] = METRICS[metric](chunk, colors)
+    if metric != 'de2000':
+        # delta_e76 gives squared distances
+        np.sqrt(costs, out=costs)
+    return costs
+
+
+def constrained_indices(pixels, palette, limits, metric='rgb'):
+    """Palette indices of an (..., 3) array using at most limits[i] pixels of color i
+    (inf for no limit), by a cost ordered greedy assignment.
+
+    Every round, each unassigned pixel proposes its next nearest color and every
+    color keeps, within its remaining budget, the pixels that would lose the most
+    by moving on to their following choice. Pixels only move away from their
+    nearest color where a budget forces them to, and a palette of k colors takes
+    at most k vectorized rounds."""
+    pixels = np.asarray(pixels)
+    remaining = np.asarray(limits, dtype=np.float64).copy()
+    costs = palette_costs(pixels, palette, metric)
+    count, colors = costs.shape
+    if remaining.shape != (colors,):
+        raise ValueError('There must be one limit per palette color.')
+    if remaining.sum() < count:
+        raise ValueError('The limits allow {0:g} bricks for {1} cells.'.format(remaining.sum(), count))
+    choices = np.argsort(costs, axis=1, kind='stable')
+    ranked = np.take_along_axis(costs, choices, axis=1)
+    indices = np.empty(count, dtype=np.uint8)
+    pending = np.arange(count)
+    for rank in range(colors):
+        if not len(pending):
+            break
+        choice = choices[pending, rank]
+        following = ranked[pending, rank + 1] if rank + 1 < colors else np.inf
+        regret = following - ranked[pending, rank]
+        order = np.lexsort((-regret, choice))
+        choice, cells = choice[order], pending[order]
+        position = np.arange(len(choice)) - np.searchsorted(choice, choice)
+        accepted = position < remaining[choice]
+        indices[cells[accepted]] = choice[accepted]
+        remaining -= np.bincount(choice[accepted], minlength=colors)
+        pending = np.sort(cells[~accepted])
+    return indices.reshape(pixels.shape[:-1])
+
+
+def quantize_batch(images, palette, bits=6, refine=False, metric='rgb'):
+    """Palette indices of several (..., 3) uint8 images in one pass. A stacked
+    (n, height, width, 3) array gives stacked indices, any other iterable of images
+    a list of grids, quantized together from one concatenated buffer."""
+    if isinstance(images, np.ndarray):
+        return quantize_array(images, palette, bits, refine, metric)
+    arrays = [np.asarray(image, dtype=np.uint8) for image in images]
+    if not arrays:
+        return []
+    flat = np.concatenate([array.reshape(-1, 3) for array in arrays])
+    indices = quantize_array(flat, palette, bits, refine, metric)
+    bounds = np.cumsum([array.size // 3 for array in arrays])[:-1]
+    return [grid.reshape(array.shape[:-1]) for grid, array in zip(np.split(indices, bounds), arrays)]
+
+
+METRICS = {
+    'rgb': delta_e76,
+    'de76': delta_e76,
+    'de2000': delta_e2000,
+    }
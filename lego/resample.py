@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.resample
+-------------
+
+This module contains the resampling used to reduce source images to
+thumbnails, and reductions of a source image straight to the brick grid.
+
+thumbnail works on every Pillow version (Image.ANTIALIAS is gone since
+Pillow 10) with any of the FILTERS. Large reductions average whole blocks of
+pixels (reduce) before the final, short filter step, optionally after letting
+the JPEG decoder scale the image down (draft), and the steps taken are
+reported.
+
+The reductions to the brick grid take the color of every brick from the
+whole block of source pixels it covers:
+
+ - 'mean': the average color of the block, computed by PIL (reduce when the
+   sizes divide, the box filter otherwise, which shares the pixels straddling
+   two blocks by area), as fast as a thumbnail
+ - 'median': the per channel median of the block, which keeps edges sharp
+ - 'mode': the palette index used by most pixels of the block, once the
+   full resolution image is quantized
+
+median and mode are quality options, not a fast path. Their blocks differ by
+at most one pixel when the sizes do not divide, and every source pixel is
+counted in numpy, one bincount per row of bricks. On a 24 MP photo reduced to
+64 studs they take about 0.35 s and 0.22 s, against 0.03 s for a Lanczos
+thumbnail or a mean downsample.
+
+    USAGE:
+    $ thumbnail, path = lego.resample.thumbnail(image, (64, 64), 'lanczos')
+    $ lego.resample.downsample(image, (64, 64), 'median')
+    $ lego.resample.block_mode(indices, (64, 48), len(palette))
+
+See README for project details.
+"""
+from __future__ import division
+
+import math
+
+import numpy as np
+from PIL import Image
+
+
+# Image.Resampling appeared in Pillow 9.1, the module level constants remain for older versions
+Resampling = getattr(Image, 'Resampling', Image)
+
+FILTERS = {
+    'nearest': Resampling.NEAREST,
+    'box': Resampling.BOX,
+    'bilinear': Resampling.BILINEAR,
+    'hamming': Resampling.HAMMING,
+    'bicubic': Resampling.BICUBIC,
+    'lanczos': Resampling.LANCZOS,
+    }
+
+# Image.resize samples these modes with nearest whatever the filter, Image.reduce only takes the others
+NEAREST_MODES = ('1', 'P')
+REDUCE_MODES = ('L', 'LA', 'La', 'RGB', 'RGBA', 'RGBa', 'RGBX', 'CMYK', 'YCbCr', 'LAB', 'HSV', 'I', 'F')
+
+DOWNSAMPLE_METHODS = ('mean', 'median', 'mode')
+
+
+def thumbnail_size(image_size, size):
+    """Size of the thumbnail PIL's Image.thumbnail would make, without enlarging."""
+    width, height = image_size
+    x, y = map(math.floor, size)
+    if x >= width and y >= height:
+        return width, height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return min(x, width), min(y, height)
+
+
+def get_filter(name):
+    if name not in FILTERS:
+        raise ValueError('The resampling filter must be one of {0}.'.format(', '.join(sorted(FILTERS))))
+    return FILTERS[name]
+
+
+def thumbnail(image, size, resample_filter='bicubic', reducing_gap=2.0, draft=False):
+    """Return (thumbnail fitting in size, path). The image is first reduced by whole factors
+    (reduce) while the filter step still shrinks by at least reducing_gap, and with the box
+    filter and sizes that divide, reduce alone gives the result. With draft, a JPEG that is
+    not loaded yet is set to decode at a reduced scale first, like PIL's Image.thumbnail
+    does: this reconfigures image itself, which then reports (and loads at) the drafted
+    size. Otherwise image is left unchanged. P and 1 images are always resized with
+    nearest, as Image.resize does, and modes reduce does not take skip it. path lists the steps taken, e.g.
+    'draft 1512x1008 + reduce 7x7 + lanczos'."""
+    method = get_filter(resample_filter)
+    if image.mode in NEAREST_MODES:
+        resample_filter, method = 'nearest', FILTERS['nearest']
+    elif image.mode not in REDUCE_MODES:
+        # Image.resize would fail reducing them, so they are resized in a single filter step
+        reducing_gap = None
+    target = thumbnail_size(image.size, size)
+    steps = []
+    box = None
+    if draft and reducing_gap is not None and target != image.size:
+        drafted = image.draft(None, (int(size[0] * reducing_gap), int(size[1] * reducing_gap)))
+        if drafted is not None:
+            box = drafted[1]
+            steps.append('draft {0}x{1}'.format(*image.size))
+    width, height = image.size
+    if target == (width, height):
+        steps.append('none')
+        return image.copy(), ' + '.join(steps)
+    if (resample_filter == 'box' and box is None and image.mode in REDUCE_MODES
+            and width % target[0] == 0 and height % target[1] == 0):
+        steps.append('reduce {0}x{1}'.format(width // target[0], height // target[1]))
+        return image.reduce((width // target[0], height // target[1])), ' + '.join(steps)
+    if reducing_gap is not None and resample_filter != 'nearest':
+        # the same factors Image.resize reduces by before filtering
+        source_width, source_height = (box[2] - box[0], box[3] - box[1]) if box else (width, height)
+        factors = (int(source_width / target[0] / reducing_gap) or 1, int(source_height / target[1] / reducing_gap) or 1)
+        if factors != (1, 1):
+            steps.append('reduce {0}x{1}'.format(*factors))
+    steps.append(resample_filter)
+    return image.resize(target, method, box=box, reducing_gap=reducing_gap), ' + '.join(steps)
+
+
+def grid_edges(length, cells):
+    """Pixel edges of cells nearly equal blocks along a side of length pixels."""
+    return np.linspace(0, length, cells + 1).round().astype(np.intp)
+
+
+def iter_bands(pixels, rows):
+    """Yield (row, band of source pixels) for every row of bricks."""
+    edges = grid_edges(pixels.shape[0], rows)
+    for row in range(rows):
+        yield row, pixels[edges[row]:edges[row + 1]]
+
+
+def column_ids(width, columns):
+    """Brick column of every source pixel column."""
+    return np.repeat(np.arange(columns, dtype=np.intp), np.diff(grid_edges(width, columns)))
+
+
+def block_mean(image, grid_size):
+    """Mean of every block of an image as a grid_size image, weighted by alpha as PIL
+    premultiplies colors, so colors hidden under transparent pixels do not count."""
+    (width, height), (columns, rows) = image.size, grid_size
+    if width % columns == 0 and height % rows == 0:
+        return image.reduce((width // columns, height // rows))
+    return image.resize(grid_size, Resampling.BOX, reducing_gap=2.0)
+
+
+def column_offsets(width, columns, bins, channels=1):
+    """(width, channels) first histogram bin of every source pixel column and channel,
+    with bins per brick column and channel."""
+    ids = column_ids(width, columns)[:, None] * channels + np.arange(channels)
+    return ids * bins
+
+
+def band_histograms(band, offsets, length, hidden=None):
+    """Counts of every brick column (and channel) of a band, in a single bincount. The
+    pixels set in the (height, width) hidden mask are left out."""
+    keys = band + offsets
+    if hidden is not None:
+        keys[hidden] = length
+    return np.bincount(keys.ravel(), minlength=length + 1)[:length]
+
+
+def block_median(pixels, grid_size, alpha=False):
+    """Lower median of every block and channel of an (height, width, channels) uint8 array,
+    read from the histograms of one row of bricks at a time. With alpha, the last channel
+    is alpha and only the pixels with some alpha count, blocks without any are transparent black."""
+    columns, rows = grid_size
+    channels = pixels.shape[2]
+    offsets = column_offsets(pixels.shape[1], columns, 256, channels)
+    medians = np.empty((rows, columns, channels), dtype=np.uint8)
+    for row, band in iter_bands(pixels, rows):
+        hidden = band[..., -1] == 0 if alpha else None
+        counts = band_histograms(band, offsets, columns * channels * 256, hidden).reshape(columns, channels, 256)
+        half = (counts[:, :1].sum(axis=2, keepdims=True) + 1) // 2
+        medians[row] = (counts.cumsum(axis=2) < half).sum(axis=2)
+    return medians
+
+
+def block_mode(indices, grid_size, count, visible=None):
+    """Most used palette index of every block of a (height, width) array of indices
+    below count, the lowest index on ties. Only the pixels set in the visible mask
+    count when it is given, blocks without any get index 0."""
+    columns, rows = grid_size
+    offsets = column_offsets(indices.shape[1], columns, count)[:, 0]
+    hidden_bands = None if visible is None else iter_bands(~visible, rows)
+    modes = np.empty((rows, columns), dtype=np.uint8)
+    for row, band in iter_bands(indices, rows):
+        hidden = None if hidden_bands is None else next(hidden_bands)[1]
+        counts = band_histograms(band, offsets, columns * count, hidden)
+        modes[row] = counts.reshape(columns, count).argmax(axis=1)
+    return modes
+
+
+def downsample(image, size, method='mean'):
+    """Reduce an image to the thumbnail size fitting in size with 'mean' or 'median' blocks.
+    L, RGB and RGBA images keep their mode, the others become RGBA when they have
+    transparency and RGB otherwise. The colors of transparent pixels never leak into
+    a block: means are weighted by alpha and medians only take the visible pixels."""
+    if method not in ('mean', 'median'):
+        raise ValueError('Images are downsampled with mean or median blocks, mode needs a palette.')
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        transparent = 'A' in image.getbands() or 'transparency' in image.info
+        image = image.convert('RGBA' if transparent else 'RGB')
+    grid_size = thumbnail_size(image.size, size)
+    if method == 'mean':
+        return block_mean(image, grid_size)
+    pixels = np.asarray(image)
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    blocks = block_median(pixels, grid_size, image.mode == 'RGBA')
+    if image.mode == 'L':
+        blocks = blocks[..., 0]
+    return Image.fromarray(np.ascontiguousarray(blocks), image.mode)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.shared
+-----------
+
+This module contains NumPy arrays backed by multiprocessing shared memory,
+used by the process pools that render or dither one image on several cores.
+
+
+    USAGE:
+    $ with lego.shared.SharedArray(shape, dtype) as shared:
+    $     executor.map(work, tasks)  # workers call lego.shared.attach(shared.spec)
+    $     result = shared.array.copy()
+
+See README for project details.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray(object):
+    """Array in a shared memory block created by this process, released on close."""
+
+    def __init__(self, shape, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(self.shape)) * self.dtype.itemsize))
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        """Picklable (name, shape, dtype) that workers pass to attach."""
+        return (self.shm.name, self.shape, self.dtype.str)
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach(spec):
+    """Open the array described by a SharedArray spec, returns (block, array)."""
+    name, shape, dtype = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 every process attaching a block registers it for cleanup
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.strips
+-----------
+
+This module contains image writers that receive a picture as consecutive
+horizontal strips, so that mosaics larger than the available memory can be
+saved one band at a time. PNG, TIFF and PPM files are supported.
+
+
+    USAGE:
+    $ with lego.strips.open_strip_writer(path, width, height) as writer:
+    $     writer.write(band)
+
+See README for project details.
+"""
+import os
+import struct
+import zlib
+
+import numpy as np
+
+
+class StripWriter(object):
+    """Base class for writers fed with (rows, width, 3) uint8 strips."""
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.file = open(path, 'wb')
+        self.write_header()
+
+    def write(self, strip):
+        """Append a strip of rows below the ones already written."""
+        strip = np.ascontiguousarray(strip, dtype=np.uint8)
+        if strip.ndim != 3 or strip.shape[1:] != (self.width, 3):
+            raise ValueError('Strips must have shape (rows, {0}, 3).'.format(self.width))
+        if self.rows_written + strip.shape[0] > self.height:
+            raise ValueError('The strips exceed the image height of {0}px.'.format(self.height))
+        self.write_strip(strip)
+        self.rows_written += strip.shape[0]
+
+    def close(self):
+        """Finish the file, which must have received every row."""
+        if self.file.closed:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError('Only {0} of {1} rows were written.'.format(self.rows_written, self.height))
+            self.write_footer()
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write_header(self):
+        pass
+
+    def write_strip(self, strip):
+        raise NotImplementedError
+
+    def write_footer(self):
+        pass
+
+
+class PPMStripWriter(StripWriter):
+    """Binary (P6) portable pixmap."""
+
+    def write_header(self):
+        self.file.write('P6\n{0} {1}\n255\n'.format(self.width, self.height).encode('ascii'))
+
+    def write_strip(self, strip):
+        self.file.write(strip.tobytes())
+
+
+class PNGStripWriter(StripWriter):
+    """Truecolor PNG, compressed incrementally into IDAT chunks."""
+
+    chunk_size = 1 << 16
+
+    def write_header(self):
+        self.compressor = zlib.compressobj(6)
+        self.pending = []
+        self.pending_size = 0
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0))
+
+    def write_strip(self, strip):
+        # every scanline is prefixed by its filter type, 1 (Sub) stores the difference to the pixel on the
+        # left, which the repeated brick texture compresses well
+        flat = strip.reshape(strip.shape[0], -1)
+        rows = np.empty((strip.shape[0], self.width * 3 + 1), dtype=np.uint8)
+        rows[:, 0] = 1
+        rows[:, 1:4] = flat[:, :3]
+        np.subtract(flat[:, 3:], flat[:, :-3], out=rows[:, 4:])
+        self.buffer(self.compressor.compress(rows.tobytes()))
+
+    def write_footer(self):
+        self.buffer(self.compressor.flush())
+        self.flush_idat()
+        self.write_chunk(b'IEND', b'')
+
+    def buffer(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= self.chunk_size:
+            self.flush_idat()
+
+    def flush_idat(self):
+        if self.pending:
+            self.write_chunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+class TIFFStripWriter(StripWriter):
+    """Uncompressed little-endian TIFF with one strip per band."""
+
+    def write_header(self):
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.rows_per_strip = None
+        # the first IFD offset is patched in once the strips are written
+        self.file.write(b'II*\x00\x00\x00\x00\x00')
+
+    def write_strip(self, strip):
+        if self.rows_per_strip is None:
+            self.rows_per_strip = strip.shape[0]
+        elif self.strip_byte_counts[-1] != self.rows_per_strip * self.width * 3:
+            raise ValueError('Only the last strip of a TIFF may be shorter than the others.')
+        data = strip.tobytes()
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+
+    def write_footer(self):
+        # (tag, type, values) with type 3 = SHORT and 4 = LONG, sorted by tag
+        entries = [(256, 4, [self.width]),
+                   (257, 4, [self.height]),
+                   (258, 3, [8, 8, 8]),
+                   (259, 3, [1]),
+                   (262, 3, [2]),
+                   (273, 4, self.strip_offsets),
+                   (277, 3, [3]),
+                   (278, 4, [self.rows_per_strip or self.height]),
+                   (279, 4, self.strip_byte_counts),
+                   (284, 3, [1])]
+        if self.file.tell() % 2:
+            self.file.write(b'\x00')
+        ifd_offset = self.file.tell()
+        extra_offset = ifd_offset + 2 + 12 * len(entries) + 4
+        ifd = [struct.pack('<H', len(entries))]
+        extra = []
+        for tag, kind, values in entries:
+            data = struct.pack('<{0}{1}'.format(len(values), 'H' if kind == 3 else 'I'), *values)
+            if len(data) <= 4:
+                ifd.append(struct.pack('<HHI', tag, kind, len(values)) + data.ljust(4, b'\x00'))
+            else:
+                ifd.append(struct.pack('<HHII', tag, kind, len(values), extra_offset))
+                extra.append(data)
+                extra_offset += len(data)
+        ifd.append(struct.pack('<I', 0))
+        self.file.write(b''.join(ifd + extra))
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', ifd_offset))
+
+
+WRITERS = {
+    '.png': PNGStripWriter,
+    '.ppm': PPMStripWriter,
+    '.tif': TIFFStripWriter,
+    '.tiff': TIFFStripWriter,
+    }
+
+
+def open_strip_writer(path, width, height):
+    """Open the strip writer matching the extension of path."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError('Streaming output supports {0} files only.'.format(', '.join(sorted(WRITERS))))
+    return WRITERS[extension](path, width, height)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+lego.vector
+-----------
+
+This module contains SVG and PDF writers for brick mosaics. Each tinted
+brick is stored once, as an SVG pattern or a PDF tiling pattern, and every
+horizontal run of equal bricks becomes a single rectangle filled with it,
+so files stay small at any print size.
+
+Mosaics of free colors would need a pattern per color, so write_tinted_svg
+stores the shading of the brick once instead: the runs are filled with
+their flat color and one filter tiles the shading over them and adds it,
+the same clipped addition the raster renderer tints bricks with. PDF has
+no such addition, free colors are written to PDF once reduced to a palette.
+
+
+    USAGE:
+    $ lego.vector.write_svg(path, grid, bricks)
+    $ lego.vector.write_pdf(path, grid, bricks)
+    $ lego.vector.write_tinted_svg(path, grid, colors, offsets)
+
+grid is a (rows, columns) array of indices into bricks, an
+(n, height, width, 3) uint8 array of tinted bricks, or into colors, an
+(n, 3) array of flat colors tinted by the (height, width, 3) offsets of the
+brick.
+
+See README for project details.
+"""
+from __future__ import division
+
+import base64
+import io
+import zlib
+
+import numpy as np
+from PIL import Image
+
+
+def iter_runs(grid):
+    """Yield (row, first column, length, brick index) for every run of equal bricks in a row."""
+    grid = np.asarray(grid)
+    columns = grid.shape[1]
+    for row, cells in enumerate(grid):
+        starts = np.concatenate([[0], np.flatnonzero(cells[1:] != cells[:-1]) + 1])
+        lengths = np.diff(np.concatenate([starts, [columns]]))
+        for start, length in zip(starts.tolist(), lengths.tolist()):
+            yield row, start, length, int(cells[start])
+
+
+def encode_png(brick):
+    buffer = io.BytesIO()
+    Image.fromarray(brick, 'RGB').save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def write_svg_header(svg, width, height):
+    svg.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+              'width="{0}" height="{1}" viewBox="0 0 {0} {1}">\n<defs>\n'.format(width, height))
+
+
+def write_svg(path, grid, bricks):
+    """Write the mosaic as an SVG with one pattern per tinted brick."""
+    rows, columns = np.shape(grid)
+    brick_height, brick_width = bricks.shape[1:3]
+    with open(path, 'w') as svg:
+        write_svg_header(svg, columns * brick_width, rows * brick_height)
+        for n, brick in enumerate(bricks):
+            svg.write('<pattern id="b{0}" width="{1}" height="{2}" patternUnits="userSpaceOnUse">'
+                      '<image width="{1}" height="{2}" xlink:href="data:image/png;base64,{3}"/>'
+                      '</pattern>\n'.format(n, brick_width, brick_height, encode_png(brick)))
+        svg.write('</defs>\n')
+        for row, column, length, n in iter_runs(grid):
+            svg.write('<rect x="{0}" y="{1}" width="{2}" height="{3}" fill="url(#b{4})"/>\n'.format(
+                column * brick_width, row * brick_height, length * brick_width, brick_height, n))
+        svg.write('</svg>\n')
+
+
+def write_tinted_svg(path, grid, colors, offsets):
+    """Write the mosaic as an SVG of flat colored runs, tinted by a single filter that stores
+    the brick once. A tint is clip(color + offset), with offsets from -100 to 100, so the
+    brick is stored as offset + 133 and the filter adds it to the colors, less 133."""
+    rows, columns = np.shape(grid)
+    brick_height, brick_width = offsets.shape[:2]
+    shading = (np.asarray(offsets) + 133).astype(np.uint8)
+    fills = ['#{0:02x}{1:02x}{2:02x}'.format(*color) for color in np.asarray(colors).tolist()]
+    with open(path, 'w') as svg:
+        write_svg_header(svg, columns * brick_width, rows * brick_height)
+        svg.write('<filter id="bricks" filterUnits="userSpaceOnUse" primitiveUnits="userSpaceOnUse" '
+                  'x="0" y="0" width="{0}" height="{1}" color-interpolation-filters="sRGB">'
+                  '<feImage x="0" y="0" width="{2}" height="{3}" preserveAspectRatio="none" result="brick" '
+                  'xlink:href="data:image/png;base64,{4}"/>'
+                  '<feTile in="brick" result="bricks"/>'
+                  '<feComposite in="SourceGraphic" in2="bricks" operator="arithmetic" k2="1" k3="1" k4="{5:.6f}"/>'
+                  '</filter>\n'.format(columns * brick_width, rows * brick_height, brick_width, brick_height,
+                                       encode_png(shading), -133 / 255))
+        svg.write('</defs>\n<g filter="url(#bricks)">\n')
+        for row, column, length, n in iter_runs(grid):
+            svg.write('<rect x="{0}" y="{1}" width="{2}" height="{3}" fill="{4}"/>\n'.format(
+                column * brick_width, row * brick_height, length * brick_width, brick_height, fills[n]))
+        svg.write('</g>\n</svg>\n')
+
+
+def write_pdf(path, grid, bricks):
+    """Write the mosaic as a single page PDF with one tiling pattern per tinted brick."""
+    rows, columns = np.shape(grid)
+    brick_height, brick_width = bricks.shape[1:3]
+    width, height = columns * brick_width, rows * brick_height
+    objects = []
+
+    def add(dictionary, stream=None):
+        objects.append((dictionary, stream))
+        return len(objects)
+
+    patterns = []
+    for brick in bricks:
+        image = add('/Type /XObject /Subtype /Image /Width {0} /Height {1} /ColorSpace /DeviceRGB '
+                    '/BitsPerComponent 8 /Filter /FlateDecode'.format(brick_width, brick_height),
+                    zlib.compress(np.ascontiguousarray(brick).tobytes()))
+        patterns.append(add('/Type /Pattern /PatternType 1 /PaintType 1 /TilingType 1 '
+                            '/BBox [0 0 {0} {1}] /XStep {0} /YStep {1} /Resources << /XObject << /B {2} 0 R >> >>'
+                            .format(brick_width, brick_height, image),
+                            'q {0} 0 0 {1} 0 0 cm /B Do Q'.format(brick_width, brick_height).encode('ascii')))
+    # PDF space grows upwards, rows are counted from the top of the page
+    content = ['/Pattern cs']
+    for row, column, length, n in iter_runs(grid):
+        content.append('/P{0} scn {1} {2} {3} {4} re f'.format(n, column * brick_width,
+                                                             height - (row + 1) * brick_height,
+                                                             length * brick_width, brick_height))
+    contents = add('/Filter /FlateDecode', zlib.compress('\n'.join(content).encode('ascii')))
+    resources = ' '.join('/P{0} {1} 0 R'.format(n, pattern) for n, pattern in enumerate(patterns))
+    pages = len(objects) + 2
+    page = add('/Type /Page /Parent {0} 0 R /MediaBox [0 0 {1} {2}] /Contents {3} 0 R '
+               '/Resources << /Pattern << {4} >> >>'.format(pages, width, height, contents, resources))
+    add('/Type /Pages /Kids [{0} 0 R] /Count 1'.format(page))
+    catalog = add('/Type /Catalog /Pages {0} 0 R'.format(pages))
+
+    with open(path, 'wb') as pdf:
+        pdf.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, (dictionary, stream) in enumerate(objects, 1):
+            offsets.append(pdf.tell())
+            if stream is None:
+                pdf.write('{0} 0 obj\n<< {1} >>\nendobj\n'.format(number, dictionary).encode('ascii'))
+            else:
+                pdf.write('{0} 0 obj\n<< {1} /Length {2} >>\nstream\n'.format(number, dictionary,
+                                                                            len(stream)).encode('ascii'))
+                pdf.write(stream)
+                pdf.write(b'\nendstream\nendobj\n')
+        xref = pdf.tell()
+        pdf.write('xref\n0 {0}\n0000000000 65535 f \n'.format(len(objects) + 1).encode('ascii'))
+        for offset in offsets:
+            pdf.write('{0:010d} 00000 n \n'.format(offset).encode('ascii'))
+        pdf.write('trailer\n<< /Size {0} /Root {1} 0 R >>\nstartxref\n{2}\n%%EOF\n'.format(
+            len(objects) + 1, catalog, xref).encode('ascii'))
@@ -6,9 +6,18 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patheffects as effects
 from matplotlib.ticker import AutoMinorLocator
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import math
 import sys
+import io
 import os
-from lego import palettes
+from lego import deepzoom, dither as diffusion, palettes, quantize, resample, shared, strips, vector
+from lego.cache import bricks as brick_cache, buffers
+
+# output bytes rendered per band by make_banded_lego_image
+BAND_BYTES = 2 * 1024 * 1024
 
 
 def apply_color_overlay(image, color):
@@ -35,22 +44,353 @@ def overlay_effect(color, overlay):
     else:
         return overlay - 133 + color
 
-def make_lego_image(thumbnail_image, brick_image):
-    '''Create a lego version of an image from an image'''
+def load_brick(brick_path):
+    '''Open a brick asset, decoding each distinct file only once per process'''
+    with open(brick_path, 'rb') as brick_file:
+        data = brick_file.read()
+    key = ('asset', hashlib.sha1(data).hexdigest())
+    brick_image = brick_cache.get(key)
+    if brick_image is None:
+        brick_image = Image.open(io.BytesIO(data))
+        brick_image.load()
+        brick_cache.put(key, brick_image, len(brick_image.tobytes()))
+    return brick_image.copy()
+
+def resize_brick(brick_image, brick_size=None):
+    '''Resample the brick once so that its longest side (or its (width, height) size) is brick_size pixels'''
+    if not brick_size:
+        return brick_image
+    if isinstance(brick_size, int):
+        scale = brick_size / max(brick_image.size)
+        brick_size = tuple(max(1, int(round(side * scale))) for side in brick_image.size)
+    if tuple(brick_size) == brick_image.size:
+        return brick_image
+    key = ('resized', get_brick_key(brick_image), tuple(brick_size))
+    resized = brick_cache.get(key)
+    if resized is None:
+        resized = brick_image.convert('RGB').resize(tuple(brick_size), Image.BOX)
+        brick_cache.put(key, resized, len(resized.tobytes()))
+    return resized.copy()
+
+def get_brick_key(brick_image):
+    '''Content hash of a brick image, shared by every cache entry derived from it'''
+    digest = hashlib.sha1('{0}{1}'.format(brick_image.mode, brick_image.size).encode())
+    digest.update(brick_image.tobytes())
+    return digest.hexdigest()
+
+def brick_offsets(brick_image, brick_key=None):
+    '''Returns the overlay_effect offset of every brick pixel, so that tinting becomes an addition'''
+    key = ('offsets', brick_key or get_brick_key(brick_image))
+    offsets = brick_cache.get(key)
+    if offsets is None:
+        levels = np.arange(256, dtype=np.int16)
+        table = np.where(levels < 33, -100, np.where(levels > 233, 100, levels - 133)).astype(np.int16)
+        offsets = table[np.asarray(brick_image.convert('RGB'))]
+        offsets.flags.writeable = False
+        brick_cache.put(key, offsets, offsets.nbytes)
+    return offsets
+
+def tint_bricks(brick_image, colors):
+    '''Tint the brick once for every color, returns an (n, height, width, 3) array'''
+    brick_key = get_brick_key(brick_image)
+    colors = [tuple(int(channel) for channel in color) for color in np.asarray(colors).reshape(-1, 3)]
+    tiles = [brick_cache.get(('tile', brick_key, color)) for color in colors]
+    missing = [n for n, tile in enumerate(tiles) if tile is None]
+    if missing:
+        offsets = brick_offsets(brick_image, brick_key)
+        tinted = np.clip(offsets + np.array([colors[n] for n in missing], dtype=np.int16).reshape(-1, 1, 1, 3),
+                         0, 255).astype(np.uint8)
+        for n, tile in zip(missing, tinted):
+            tile = tile.copy()
+            tile.flags.writeable = False
+            tiles[n] = brick_cache.put(('tile', brick_key, colors[n]), tile, tile.nbytes)
+    return np.stack(tiles) if tiles else np.empty((0,) + brick_image.size[::-1] + (3,), dtype=np.uint8)
+
+def get_palette_colors(thumbnail_image):
+    '''Returns the palette of a P mode image as a (256, 3) array'''
+    palette = np.zeros((256, 3), dtype=np.int16)
+    flat = np.array(thumbnail_image.getpalette() or [], dtype=np.int16).reshape(-1, 3)[:256]
+    palette[:len(flat)] = flat
+    return palette
+
+def index_bricks(thumbnail_image, brick_image):
+    '''Returns the grid of a palette image as indices into the bricks tinted with the colors in use'''
+    indices = np.asarray(thumbnail_image)
+    used, grid = np.unique(indices, return_inverse=True)
+    bricks = tint_bricks(brick_image, get_palette_colors(thumbnail_image)[used])
+    return grid.reshape(indices.shape), bricks
+
+def paste_bricks(grid, bricks, out=None):
+    '''Lay out the bricks referenced by a grid of indices as a (height, width, channels) array, optionally
+    into a preallocated out array of shape (rows, height, columns, width, channels)'''
+    rows, columns = grid.shape
+    brick_height, brick_width, channels = bricks.shape[1:]
+    if out is None:
+        out = np.empty((rows, brick_height, columns, brick_width, channels), dtype=bricks.dtype)
+    # the pixel rows of the bricks side by side, so that a row of bricks is gathered straight into place
+    lines = np.ascontiguousarray(bricks.reshape(len(bricks), brick_height, -1).transpose(1, 0, 2))
+    for row in range(rows):
+        np.take(lines, grid[row], axis=1, out=out[row].reshape(brick_height, columns, -1), mode='clip')
+    return out.reshape(rows * brick_height, columns * brick_width, channels)
+
+def overlay_bricks(colors, offsets, out=None):
+    '''Overlay the brick offsets on a grid of colors as a (height, width, 3) array, optionally into a
+    preallocated uint8 out array of shape (rows, height, columns, width, 3). The offsets are added with
+    uint8 saturating arithmetic along whole pixel rows, so no wider intermediate is needed'''
+    rows, columns = colors.shape[:2]
+    brick_height, brick_width = offsets.shape[:2]
+    if out is None:
+        out = np.empty((rows, brick_height, columns, brick_width, 3), dtype=np.uint8)
+    lines = out.reshape(rows, brick_height, columns * brick_width * 3)
+    # every pixel row of a brick row repeats the cell colors, and the offsets repeat along it
+    line_colors = np.repeat(np.asarray(colors, dtype=np.uint8), brick_width, axis=1).reshape(rows, 1, -1)
+    raised = np.tile(np.maximum(offsets, 0).astype(np.uint8), (1, columns, 1)).reshape(1, brick_height, -1)
+    lowered = np.tile(np.maximum(-offsets, 0).astype(np.uint8), (1, columns, 1)).reshape(1, brick_height, -1)
+    # min(c, 255 - raised) + raised saturates at 255, max(c, lowered) - lowered at 0
+    np.minimum(line_colors, 255 - raised, out=lines)
+    lines += raised
+    np.maximum(lines, lowered, out=lines)
+    lines -= lowered
+    return out.reshape(rows * brick_height, columns * brick_width, 3)
+
+def make_indexed_lego_image(thumbnail_image, brick_image):
+    '''Create a lego version of a palette image, tinting the brick only once per palette entry'''
+    return make_banded_lego_image(*index_bricks(thumbnail_image, brick_image))
+
+def index_colors(bricks):
+    '''Returns the distinct colors of an array of bricks and the bricks as indices into them'''
+    packed = np.dot(bricks.astype(np.uint32), np.array([1 << 16, 1 << 8, 1], dtype=np.uint32))
+    keys, indices = np.unique(packed, return_inverse=True)
+    colors = np.stack([keys >> 16, (keys >> 8) & 255, keys & 255], axis=-1).astype(np.uint8)
+    return colors, indices.reshape(packed.shape + (1,)).astype(np.uint8 if len(colors) <= 256 else np.uint32)
+
+def make_paletted_lego_image(thumbnail_image, brick_image, shading_levels=None):
+    '''Create a lego version of a palette image as a P mode image. When the tinted bricks need more than
+    256 colors, the brick shading is reduced to shading_levels shades (at most 256 // colors in use) if
+    given, which changes the look of the bricks. Otherwise, or if that is not possible, RGB is returned'''
+    grid, bricks = index_bricks(thumbnail_image, brick_image)
+    colors, indexed_bricks = index_colors(bricks)
+    if len(colors) > 256:
+        shading_levels = min(shading_levels or 0, 256 // len(bricks))
+        if shading_levels < 2:
+            return make_banded_lego_image(grid, bricks)
+        brick_image = brick_image.convert('RGB').quantize(shading_levels).convert('RGB')
+        grid, bricks = index_bricks(thumbnail_image, brick_image)
+        colors, indexed_bricks = index_colors(bricks)
+    lego_image = Image.fromarray(paste_bricks(grid, indexed_bricks)[:, :, 0], 'P')
+    lego_image.putpalette(colors.flatten().tolist())
+    return lego_image
+
+def make_rgb_lego_image(thumbnail_image, brick_image):
+    '''Create a lego version of an image with any number of colors, overlaying the brick offsets band by band'''
+    return make_banded_lego_image(np.asarray(thumbnail_image.convert('RGB'), dtype=np.int16),
+                                  brick_offsets(brick_image))
+
+def get_lego_grid(thumbnail_image, brick_image):
+    '''Returns the brick grid of a thumbnail with the bricks it needs: an index grid and tinted bricks
+    for palette images, a color grid and the brick offsets otherwise'''
+    if thumbnail_image.mode == 'P':
+        return index_bricks(thumbnail_image, brick_image)
+    return np.asarray(thumbnail_image.convert('RGB'), dtype=np.int16), brick_offsets(brick_image)
+
+def render_bricks(grid, bricks, out=None):
+    '''Render (part of) a grid returned by get_lego_grid as a (height, width, 3) array, optionally into
+    a preallocated out array of shape (rows, height, columns, width, 3)'''
+    if grid.ndim == 2:
+        return paste_bricks(grid, bricks, out)
+    return overlay_bricks(grid, bricks, out)
+
+def make_banded_lego_image(grid, bricks, band_bytes=None):
+    '''Render a grid returned by get_lego_grid into one RGB image, a band of brick rows of at most
+    band_bytes (BAND_BYTES) output pixels at a time, so only the bands are held as arrays'''
+    rows, columns = grid.shape[:2]
+    brick_height, brick_width = bricks.shape[-3:-1]
+    row_bytes = brick_height * columns * brick_width * 3
+    band_height = max(1, min(rows, (band_bytes or BAND_BYTES) // max(row_bytes, 1)))
+    # every pixel is pasted from a band, so the image is not initialised
+    lego_image = Image.new('RGB', (columns * brick_width, rows * brick_height), None)
+    with buffers.borrowed((band_height, brick_height, columns, brick_width, 3)) as out:
+        for top in range(0, rows, band_height):
+            band = grid[top:top + band_height]
+            pixels = render_bricks(band, bricks, out[:len(band)])
+            lego_image.paste(Image.fromarray(pixels, 'RGB'), (0, top * brick_height))
+    return lego_image
+
+def iter_lego_bands(thumbnail_image, brick_image, band_height=1):
+    '''Yields the lego image as (height, width, 3) arrays covering band_height brick rows each'''
+    grid, bricks = get_lego_grid(thumbnail_image, brick_image)
+    for top in range(0, grid.shape[0], band_height):
+        yield render_bricks(grid[top:top + band_height], bricks)
+
+def save_lego_image(thumbnail_image, brick_image, output_path, band_height=1):
+    '''Render and write a lego image band by band, without allocating the full canvas'''
     base_width, base_height = thumbnail_image.size
     brick_width, brick_height = brick_image.size
+    with strips.open_strip_writer(output_path, base_width * brick_width, base_height * brick_height) as writer:
+        for band in iter_lego_bands(thumbnail_image, brick_image, band_height):
+            writer.write(band)
+
+_band_worker = {}
+
+def _init_band_worker(canvas_spec, grid, bricks):
+    shm, canvas = shared.attach(canvas_spec)
+    _band_worker.update(shm=shm, canvas=canvas, grid=grid, bricks=bricks)
+
+def _render_band(rows):
+    grid, bricks = _band_worker['grid'], _band_worker['bricks']
+    brick_height = bricks.shape[-3]
+    _band_worker['canvas'][rows.start * brick_height:rows.stop * brick_height] = render_bricks(grid[rows], bricks)
+
+def make_parallel_lego_image(thumbnail_image, brick_image, workers, band_height=8):
+    '''Create a lego image with a pool of processes rendering bands into a shared canvas'''
+    grid, bricks = get_lego_grid(thumbnail_image, brick_image)
+    brick_height, brick_width = bricks.shape[-3:-1]
+    shape = (grid.shape[0] * brick_height, grid.shape[1] * brick_width, 3)
+    with shared.SharedArray(shape) as canvas:
+        bands = [slice(top, min(top + band_height, grid.shape[0])) for top in range(0, grid.shape[0], band_height)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_band_worker,
+                                 initargs=(canvas.spec, grid, bricks)) as executor:
+            list(executor.map(_render_band, bands))
+        # RGB arrays are always copied into PIL's own storage, so the block can be released
+        return Image.fromarray(canvas.array, 'RGB')
+
+def get_brick_mask(thumbnail_image, alpha_threshold=128):
+    '''Returns which cells are opaque enough to get a brick, or None when the thumbnail has no transparency'''
+    if 'A' not in thumbnail_image.getbands() and 'transparency' not in thumbnail_image.info:
+        return None
+    return np.asarray(thumbnail_image.convert('RGBA'))[:, :, 3] >= alpha_threshold
+
+def make_masked_lego_image(thumbnail_image, brick_image, mask):
+    '''Create an RGBA lego image with bricks only on the cells selected by mask, leaving the rest transparent'''
+    grid, bricks = get_lego_grid(thumbnail_image, brick_image)
+    brick_height, brick_width = bricks.shape[-3:-1]
+    rows, columns = np.nonzero(mask)
+    if grid.ndim == 2:
+        cells = bricks[grid[rows, columns]]
+    else:
+        cells = np.clip(bricks[None] + grid[rows, columns][:, None, None, :], 0, 255).astype(np.uint8)
+    canvas = np.zeros((grid.shape[0], brick_height, grid.shape[1], brick_width, 4), dtype=np.uint8)
+    canvas[rows, :, columns, :, :3] = cells
+    canvas[rows, :, columns, :, 3] = 255
+    return Image.fromarray(canvas.reshape(grid.shape[0] * brick_height, grid.shape[1] * brick_width, 4), 'RGBA')
+
+def make_lego_image(thumbnail_image, brick_image, workers=1, band_height=8, brick_size=None, indexed=False,
+                    mask=None, shading_levels=None):
+    '''Create a lego version of an image from an image'''
+    brick_image = resize_brick(brick_image, brick_size)
+    if mask is not None:
+        return make_masked_lego_image(thumbnail_image, brick_image, mask)
+    if indexed and thumbnail_image.mode == 'P':
+        return make_paletted_lego_image(thumbnail_image, brick_image, shading_levels)
+    if workers > 1:
+        return make_parallel_lego_image(thumbnail_image, brick_image, workers, band_height)
+    if thumbnail_image.mode == 'P':
+        return make_indexed_lego_image(thumbnail_image, brick_image)
+    return make_rgb_lego_image(thumbnail_image, brick_image)
+
+def iter_progressive_lego_images(thumbnail_image, brick_image, preview_brick_size=8):
+    '''Yields the lego image from coarse to fine: flat colors with one pixel per brick, a render with
+    bricks of preview_brick_size pixels, then the full render. The brick grid is only worked out once.'''
+    if thumbnail_image.mode == 'P':
+        indices = np.asarray(thumbnail_image)
+        used, grid = np.unique(indices, return_inverse=True)
+        grid = grid.reshape(indices.shape)
+        colors = get_palette_colors(thumbnail_image)[used]
+        yield Image.fromarray(colors.astype(np.uint8)[grid], 'RGB')
+        render = lambda brick: paste_bricks(grid, tint_bricks(brick, colors))
+    else:
+        colors = np.asarray(thumbnail_image.convert('RGB'), dtype=np.int16)
+        yield Image.fromarray(colors.astype(np.uint8), 'RGB')
+        render = lambda brick: overlay_bricks(colors, brick_offsets(brick))
+    if preview_brick_size and preview_brick_size < max(brick_image.size):
+        yield Image.fromarray(render(resize_brick(brick_image, preview_brick_size)), 'RGB')
+    yield Image.fromarray(render(brick_image), 'RGB')
+
+def save_vector_lego_image(thumbnail_image, brick_image, out_path):
+    '''Write the lego image as an SVG or PDF file (chosen by extension) storing each tinted brick once.
+    Free colors (thumbnails not in P mode) store the brick a single time and can only be written to SVG.'''
+    extension = os.path.splitext(out_path)[1].lower()
+    if extension not in ('.svg', '.pdf'):
+        raise ValueError('Vector output supports .svg and .pdf files only.')
+    if thumbnail_image.mode != 'P':
+        if extension == '.pdf':
+            raise ValueError('PDF output needs a palette (P mode) thumbnail, free colors can be written to SVG.')
+        colors = np.asarray(thumbnail_image.convert('RGB'))
+        used, grid = np.unique(colors.reshape(-1, 3), axis=0, return_inverse=True)
+        vector.write_tinted_svg(out_path, grid.reshape(colors.shape[:2]), used, brick_offsets(brick_image))
+    elif extension == '.svg':
+        vector.write_svg(out_path, *index_bricks(thumbnail_image, brick_image))
+    else:
+        vector.write_pdf(out_path, *index_bricks(thumbnail_image, brick_image))
+
+def get_changed_cells(previous_thumbnail, thumbnail_image):
+    '''Returns the rows and columns of the cells whose color differs between two thumbnails'''
+    if previous_thumbnail.size != thumbnail_image.size:
+        raise Exception('Only thumbnails of the same size can be compared.')
+    previous = np.asarray(previous_thumbnail.convert('RGB'))
+    current = np.asarray(thumbnail_image.convert('RGB'))
+    return np.nonzero((previous != current).any(axis=2))
+
+def update_lego_image(lego_image, previous_thumbnail, thumbnail_image, brick_image, out_path=None):
+    '''Re-tint and paste only the cells that changed since previous_thumbnail was rendered as lego_image'''
+    brick_width, brick_height = brick_image.size
+    if lego_image.size != (thumbnail_image.size[0] * brick_width, thumbnail_image.size[1] * brick_height):
+        raise Exception('The lego image was not rendered from a thumbnail of this size with this brick.')
+    if lego_image.mode != 'RGB':
+        lego_image = lego_image.convert('RGB')
+    rows, columns = get_changed_cells(previous_thumbnail, thumbnail_image)
+    if len(rows):
+        colors = np.asarray(thumbnail_image.convert('RGB'))[rows, columns]
+        used, cells = np.unique(colors, axis=0, return_inverse=True)
+        bricks = [Image.fromarray(brick, 'RGB') for brick in tint_bricks(brick_image, used)]
+        for row, column, cell in zip(rows, columns, cells.ravel()):
+            lego_image.paste(bricks[cell], (int(column) * brick_width, int(row) * brick_height))
+    if out_path:
+        lego_image.save(out_path)
+    return lego_image
 
-    rgb_image = thumbnail_image.convert('RGB')
+def make_region_renderer(thumbnail_image, brick_image, scale):
+    '''Returns a function rendering boxes of the lego image scaled by scale, built from bricks
+    resampled to that scale instead of from the full resolution canvas'''
+    brick_width, brick_height = brick_image.size
+    cell_width, cell_height = brick_width * scale, brick_height * scale
+    if scale < 1:
+        brick_image = resize_brick(brick_image, (max(1, int(math.ceil(cell_width))),
+                                                 max(1, int(math.ceil(cell_height)))))
+    grid, bricks = get_lego_grid(thumbnail_image, brick_image)
+    brick_width, brick_height = brick_image.size
 
-    lego_image = Image.new("RGB", (base_width * brick_width,
-                                   base_height * brick_height), "white")
+    def render(box):
+        left, upper, right, lower = box
+        first_column, first_row = int(left // cell_width), int(upper // cell_height)
+        last_column = min(grid.shape[1], int(math.ceil(right / cell_width)))
+        last_row = min(grid.shape[0], int(math.ceil(lower / cell_height)))
+        region = Image.fromarray(render_bricks(grid[first_row:last_row, first_column:last_column], bricks), 'RGB')
+        source_box = ((left - first_column * cell_width) * brick_width / cell_width,
+                      (upper - first_row * cell_height) * brick_height / cell_height,
+                      (right - first_column * cell_width) * brick_width / cell_width,
+                      (lower - first_row * cell_height) * brick_height / cell_height)
+        if scale >= 1:
+            return region.crop(tuple(int(round(side)) for side in source_box))
+        # level sizes are rounded up, so the last box may reach past the bricks by a fraction of a pixel
+        source_box = (source_box[0], source_box[1],
+                      min(source_box[2], region.size[0]), min(source_box[3], region.size[1]))
+        return region.resize((right - left, lower - upper), Image.BOX, box=source_box)
+    return render
+
+def make_lego_pyramid(thumbnail_image, brick_image, tile_size=254, overlap=1, tile_format='png'):
+    '''Returns a lazily rendered deep zoom pyramid of the lego image'''
+    base_width, base_height = thumbnail_image.size
+    brick_width, brick_height = brick_image.size
+    return deepzoom.DeepZoomPyramid(base_width * brick_width, base_height * brick_height,
+                                    lambda scale: make_region_renderer(thumbnail_image, brick_image, scale),
+                                    tile_size, overlap, tile_format)
 
-    for brick_x in range(base_width):
-        for brick_y in range(base_height):
-            color = rgb_image.getpixel((brick_x, brick_y))
-            lego_image.paste(apply_color_overlay(brick_image, color),
-                             (brick_x * brick_width, brick_y * brick_height))
-    return lego_image
+def save_lego_pyramid(thumbnail_image, brick_image, dzi_path, workers=1, tile_size=254, overlap=1, tile_format='png'):
+    '''Write the lego image as a deep zoom (.dzi) tile pyramid, without rendering the full canvas'''
+    pyramid = make_lego_pyramid(thumbnail_image, brick_image, tile_size, overlap, tile_format)
+    pyramid.save(dzi_path, workers)
+    return pyramid
 
 
 def get_new_filename(file_path, ext_override=None):
@@ -84,9 +424,7 @@ def get_new_size(base_image, brick_image, size=None):
 
 def get_lego_palette(palette_mode):
     '''Gets the palette for the specified lego palette mode'''
-    legos = palettes.legos()
-    palette = legos[palette_mode]
-    return palettes.extend_palette(palette)
+    return list(palettes.get_palette(palette_mode).flat)
 
 def quantize_to_palette(image, palette, dither):
     """Convert an RGB or L mode image to use a given P image's palette."""
@@ -103,13 +441,68 @@ def quantize_to_palette(image, palette, dither):
     except AttributeError:
         return image._makeself(im)
 
-def apply_thumbnail_effects(image, palette, dither=False):
-    '''Apply effects on the reduced image before Legofying'''
-    palette_image = Image.new("P", (1, 1))
-    palette_image.putpalette(palette)
+def indices_to_image(indices, palette):
+    '''Build a P mode image from an array of palette indices'''
+    image = Image.fromarray(np.ascontiguousarray(indices, dtype=np.uint8), 'P')
+    image.putpalette(palette.flat)
+    return image
+
+def apply_thumbnail_effects(image, palette, dither=False, refine=False, metric='rgb', workers=1, limits=None):
+    '''Apply effects on the reduced image before Legofying. The palette is either a compiled
+    palettes.Palette or a flat list of colors. Without dithering, RGB images are mapped to a
+    compiled palette through its lookup table, exactly like PIL does, or to the exact
+    nearest color when refine is set. The perceptual metrics ('de76', 'de2000') compare
+    colors in CIELAB and need a compiled palette.
+    dither is True for PIL's Floyd-Steinberg, the name of a lego.dither kernel
+    ('floyd-steinberg', 'atkinson', 'sierra'), diffused on workers processes, or of an
+    ordered pattern ('bayer4', 'bayer8', 'blue-noise'), thresholded on workers threads.
+    limits caps the bricks of some colors ({letter: bricks}), the other cells are moved to
+    their next nearest color with bricks left'''
+    if metric != 'rgb':
+        if dither or not isinstance(palette, palettes.Palette):
+            raise ValueError('The {0} metric needs a compiled palette and no dithering.'.format(metric))
+        image = image.convert('RGB')
+    if limits is not None:
+        if dither or not isinstance(palette, palettes.Palette):
+            raise ValueError('Brick limits need a compiled palette and no dithering.')
+        indices = quantize.constrained_indices(np.asarray(image.convert('RGB')), palette,
+                                               palette.limit_array(limits), metric)
+        return indices_to_image(indices, palette)
+    if isinstance(dither, str):
+        if not isinstance(palette, palettes.Palette):
+            raise ValueError('Dithering kernels and patterns need a compiled palette.')
+        pixels = np.asarray(image.convert('RGB'))
+        if dither in diffusion.PATTERNS:
+            indices = diffusion.ordered(pixels, palette, dither, workers=workers)
+        else:
+            indices = diffusion.diffuse(pixels, palette, dither, workers=workers)
+        return indices_to_image(indices, palette)
+    if isinstance(palette, palettes.Palette) and not dither and image.mode == 'RGB':
+        indices = quantize.quantize_array(np.asarray(image), palette, refine=refine, metric=metric)
+        return indices_to_image(indices, palette)
+    if isinstance(palette, palettes.Palette):
+        palette_image = palette.image
+    else:
+        palette_image = Image.new("P", (1, 1))
+        palette_image.putpalette(palette)
     return quantize_to_palette(image, palette_image, dither)
     
-def palette_thumbnail(image, size, palette_mode='all', dither=False):
+def mode_thumbnail(image, size, palette, metric='rgb'):
+    ''' Quantize the image at full resolution and give every brick of the thumbnail fitting in
+    size the palette color most of its visible pixels got. The rgb metric quantizes in PIL, which gives
+    the same indices as the lookup table without gathering every pixel through it. '''
+    if metric == 'rgb':
+        indices = np.asarray(quantize_to_palette(image.convert('RGB'), palette.image, False))
+    else:
+        indices = quantize.quantize_array(np.asarray(image.convert('RGB')), palette, metric=metric)
+    visible = None
+    if 'A' in image.getbands() or 'transparency' in image.info:
+        visible = np.asarray(image.convert('RGBA').getchannel('A')) > 0
+    grid = resample.block_mode(indices, resample.thumbnail_size(image.size, size), len(palette), visible)
+    return indices_to_image(grid, palette)
+
+def palette_thumbnail(image, size, palette_mode='all', dither=False, metric='rgb', downsample=None,
+                      resample_filter='bicubic'):
     ''' Reduce the image to thumbnail and converts the colors to the selected palette. 
 
     image: path to the original image
@@ -117,23 +510,89 @@ def palette_thumbnail(image, size, palette_mode='all', dither=False):
     palette_mode: 
     - grayscale (5 shades of gray)
     - solid
+    dither: False, True or the name of a lego.dither kernel or pattern
+    downsample: None to resample with resample_filter (see lego.resample.FILTERS), or 'mean',
+    'median' or 'mode' to reduce every brick's block of source pixels (see lego.resample)
     '''
-    image.thumbnail(size)
-    palette = get_lego_palette(palette_mode)
-    converted_image = apply_thumbnail_effects(image, palette, dither)
+    palette = palettes.get_palette(palette_mode)
+    if downsample == 'mode':
+        if dither:
+            raise ValueError('Mode downsampling quantizes before reducing and cannot be dithered.')
+        return mode_thumbnail(image, size, palette, metric)
+    if downsample:
+        image = resample.downsample(image, size, downsample)
+    else:
+        image, _ = resample.thumbnail(image, size, resample_filter)
+    converted_image = apply_thumbnail_effects(image, palette, dither, metric=metric)
     return converted_image
 
-def legofy_image(base_image, brick_image, output_path, size, palette_mode, dither):
-    '''Legofy an image'''
+def quantize_thumbnails(images, palette, metric='rgb'):
+    ''' Convert several thumbnails to a compiled palette, the RGB ones in a single batch that
+    reuses the palette lookups. Returns a list of P images. '''
+    converted = [None] * len(images)
+    batch = [n for n, image in enumerate(images) if image.mode == 'RGB' or metric != 'rgb']
+    grids = quantize.quantize_batch([np.asarray(images[n].convert('RGB')) for n in batch], palette, metric=metric)
+    for n, grid in zip(batch, grids):
+        converted[n] = indices_to_image(grid, palette)
+    for n, image in enumerate(images):
+        if converted[n] is None:
+            converted[n] = apply_thumbnail_effects(image, palette)
+    return converted
+
+def palette_thumbnail_batch(images, size, palette_mode='all', metric='rgb', resample_filter='bicubic'):
+    ''' Reduce several images to thumbnails and convert them to the selected palette in one batch. '''
+    thumbnails = [resample.thumbnail(image, size, resample_filter)[0] for image in images]
+    return quantize_thumbnails(thumbnails, palettes.get_palette(palette_mode), metric)
+
+def palette_thumbnails(image, size, palette_modes, metric='rgb', resample_filter='bicubic'):
+    ''' Reduce the image to thumbnail once and convert it to several palettes in a single
+    quantization pass. Returns a {palette_mode: P image} dictionary. '''
+    image, _ = resample.thumbnail(image, size, resample_filter)
+    palette_list = [palettes.get_palette(palette_mode) for palette_mode in palette_modes]
+    grids = quantize.quantize_palettes(np.asarray(image.convert('RGB')), palette_list, metric=metric)
+    return dict((palette.name, indices_to_image(grid, palette)) for palette, grid in zip(palette_list, grids))
+
+def legofy_image(base_image, brick_image, output_path, size, palette_mode, dither, stream=False, brick_size=None,
+                 alpha_threshold=None, metric='rgb', downsample=None, resample_filter='lanczos', indexed=False,
+                 shading_levels=None, draft=False):
+    '''Legofy an image. With indexed and a palette, the result is written as a P mode image
+    (see make_paletted_lego_image for shading_levels), which is not streamed. With draft, a JPEG
+    base_image that is not loaded yet is decoded at a reduced scale (see lego.resample.thumbnail).
+    Returns the resampling steps taken, or None when the image was downsampled'''
     new_size = get_new_size(base_image, brick_image, size)
-    base_image.thumbnail(new_size, Image.ANTIALIAS)
+    if downsample == 'mode' and (not palette_mode or dither):
+        raise ValueError('Mode downsampling needs a palette and no dithering.')
+    source_image = base_image
+    resample_path = None
+    if downsample == 'mode':
+        # only the alpha channel of the averaged blocks is used, for the mask
+        base_image = resample.downsample(base_image, new_size, 'mean') if alpha_threshold is not None else None
+    elif downsample:
+        base_image = resample.downsample(base_image, new_size, downsample)
+    else:
+        base_image, resample_path = resample.thumbnail(base_image, new_size, resample_filter, draft=draft)
+    mask = None
+    if alpha_threshold is not None:
+        mask = get_brick_mask(base_image, alpha_threshold)
+    if mask is not None:
+        base_image = base_image.convert('RGB')
     if palette_mode:
-        palette = get_lego_palette(palette_mode)
-        base_image = apply_thumbnail_effects(base_image, palette, dither)
-    make_lego_image(base_image, brick_image).save(output_path)
+        palette = palettes.get_palette(palette_mode)
+        if downsample == 'mode':
+            base_image = mode_thumbnail(source_image, new_size, palette, metric)
+        else:
+            base_image = apply_thumbnail_effects(base_image, palette, dither, metric=metric)
+    brick_image = resize_brick(brick_image, brick_size)
+    if stream and mask is None and not indexed:
+        save_lego_image(base_image, brick_image, output_path)
+    else:
+        make_lego_image(base_image, brick_image, indexed=indexed, mask=mask,
+                        shading_levels=shading_levels).save(output_path)
+    return resample_path
 
 def main(image_path, output_path=None, size=None,
-         palette_mode=None, dither=False):
+         palette_mode=None, dither=False, stream=False, brick_size=None, alpha_threshold=None, metric='rgb',
+         downsample=None, resample_filter='lanczos', indexed=False, shading_levels=None):
     '''Legofy image or gif with brick_path mask'''
     image_path = os.path.realpath(image_path)
     if not os.path.isfile(image_path):
@@ -148,7 +607,7 @@ def main(image_path, output_path=None, size=None,
         sys.exit(1)
 
     base_image = Image.open(image_path)
-    brick_image = Image.open(brick_path)
+    brick_image = load_brick(brick_path)
 
     if palette_mode:
         print ("LEGO Palette {0} selected...".format(palette_mode.title()))
@@ -158,7 +617,12 @@ def main(image_path, output_path=None, size=None,
     if output_path is None:
         output_path = get_new_filename(image_path, '.png')
     print("Static image detected, will now legofy to {0}".format(output_path))
-    legofy_image(base_image, brick_image, output_path, size, palette_mode, dither)
+    # the image was opened here, so the JPEG decoder may scale it down
+    resample_path = legofy_image(base_image, brick_image, output_path, size, palette_mode, dither, stream,
+                                 brick_size, alpha_threshold, metric, downsample, resample_filter, indexed,
+                                 shading_levels, draft=base_image.format == 'JPEG')
+    if resample_path:
+        print("Resampled: {0}".format(resample_path))
 
     base_image.close()
     brick_image.close()
@@ -168,10 +632,10 @@ def main(image_path, output_path=None, size=None,
 # =================  PRE PROCESSING AND PREVIEW  ================= #
       
 
-def default_effect(image, effect, size, palette_mode, factor): 
+def default_effect(image, effect, size, palette_mode, factor, metric='rgb'):
     if 0 <= effect <= 9:
         effects = default_preview(image, factor)
-        return palette_thumbnail(effects[effect], size, palette_mode, dither=False)
+        return palette_thumbnail(effects[effect], size, palette_mode, dither=False, metric=metric)
     else:
         raise Exception('The effect number must be within 0 and 9.')
 
@@ -186,8 +650,9 @@ def custom_effect(image, color=0, brightness=0, contrast=0, sharpness=0):
         image = [ImageEnhance.Sharpness(image).enhance(sharpness + 1), image][sharpness == 0]
         return image
 
-def pre_process(image, size=None, effect=0, out_path=None, palette_mode='solid', factor=0.5, color=0, brightness=0, contrast=0, sharpness=0):
-  ''' Generate a preview of the final result and tweak the image parameters. '''
+def effect_thumbnail(image, size=None, effect=0, factor=0.5, color=0, brightness=0, contrast=0, sharpness=0,
+                     resample_filter='bicubic'):
+  ''' Apply the pre_process enhancements and reduce the image, before quantization. '''
   if size:
     size_x, size_y = size
   else:
@@ -195,31 +660,69 @@ def pre_process(image, size=None, effect=0, out_path=None, palette_mode='solid',
 
   if color != 0 or brightness != 0 or contrast != 0 or sharpness != 0:
     image = custom_effect(image, color, brightness, contrast, sharpness)
-    image = palette_thumbnail(image, size=(size_x, size_y), palette_mode=palette_mode, dither=False)
-    quadrants_x, quadrants_y, unit = count_quadrants(image)
-    image = image.crop((0, 0, quadrants_x * unit, quadrants_y * unit))
-    if out_path:
-        image.save(out_path)
-    return image
+  elif 0 <= effect <= 9:
+    image = default_preview(image, factor)[effect]
   else:
-    image = default_effect(image, effect, size, palette_mode, factor) 
-    quadrants_x, quadrants_y, unit = count_quadrants(image)
-    image = image.crop((0, 0, quadrants_x * unit, quadrants_y * unit))
-    if out_path:
-        image.save(out_path)
-    return image
+    raise Exception('The effect number must be within 0 and 9.')
+  image, _ = resample.thumbnail(image, (size_x, size_y), resample_filter)
+  return image
+
+def crop_to_quadrants(image, out_path=None):
+  ''' Crop a pre processed image to whole instruction quadrants and save it. '''
+  quadrants_x, quadrants_y, unit = count_quadrants(image)
+  image = image.crop((0, 0, quadrants_x * unit, quadrants_y * unit))
+  if out_path:
+      image.save(out_path)
+  return image
+
+def pre_process(image, size=None, effect=0, out_path=None, palette_mode='solid', factor=0.5, color=0, brightness=0, contrast=0, sharpness=0, metric='rgb', limits=None):
+  ''' Generate a preview of the final result and tweak the image parameters. limits caps the
+  bricks of some colors, see available_bricks. '''
+  image = effect_thumbnail(image, size, effect, factor, color, brightness, contrast, sharpness)
+  image = apply_thumbnail_effects(image, palettes.get_palette(palette_mode), dither=False, metric=metric, limits=limits)
+  return crop_to_quadrants(image, out_path)
+
+def pre_process_batch(images, settings, out_paths=None, metric='rgb'):
+  ''' Pre process several images, settings holding the pre_process keyword arguments of each
+  image (size, effect, palette_mode, factor, color, brightness, contrast, sharpness, limits).
+  The thumbnails sharing a palette and without brick limits are quantized in one batch. '''
+  thumbnails = []
+  for image, image_settings in zip(images, settings):
+    image_settings = dict(image_settings)
+    image_settings.pop('palette_mode', None)
+    image_settings.pop('limits', None)
+    thumbnails.append(effect_thumbnail(image, **image_settings))
+
+  processed = [None] * len(thumbnails)
+  for n, image_settings in enumerate(settings):
+    if image_settings.get('limits') is not None:
+      image = apply_thumbnail_effects(thumbnails[n], palettes.get_palette(image_settings.get('palette_mode', 'solid')),
+                                      metric=metric, limits=image_settings['limits'])
+      processed[n] = crop_to_quadrants(image, out_paths[n] if out_paths else None)
+  unlimited = [image_settings.get('palette_mode', 'solid') if image_settings.get('limits') is None else None
+               for image_settings in settings]
+  for palette_mode in set(unlimited) - set([None]):
+    batch = [n for n, image_palette_mode in enumerate(unlimited) if image_palette_mode == palette_mode]
+    converted = quantize_thumbnails([thumbnails[n] for n in batch], palettes.get_palette(palette_mode), metric)
+    for n, image in zip(batch, converted):
+      processed[n] = crop_to_quadrants(image, out_paths[n] if out_paths else None)
+  return processed
 
 def multi_preview(image, size=None, out_path=None, palette_mode='all', factor=0.5):
   ''' Generate standard combinations of enhancement parameters. '''  
+  multi_palette_preview(image, size, {palette_mode: out_path}, factor)
+
+def multi_palette_preview(image, size, out_paths, factor=0.5):
+  ''' Generate the standard previews for several palettes, out_paths maps each palette mode
+  to its PDF path (None to not save it) and size may be None to keep the image size.
+  Every effect is reduced and quantized to all the palettes in one pass. '''
   if size:
     size_x, size_y = size
   else:
     size_x, size_y = image.size
-    
+
   previews = default_preview(image, factor)
-  fig, axs = plt.subplots(5,2, figsize=(10, 20), dpi=40)
-  plt.subplots_adjust(wspace=0.1, hspace=0)
-  plt.suptitle(f'Palette: {palette_mode.upper()}', va='bottom') 
+  thumbnails = [palette_thumbnails(preview, (size_x, size_y), list(out_paths)) for preview in previews]
   titles = {
             0:  'Original image (effect=0)', 
             1:  'Very high contrast(effect=1)',
@@ -233,19 +736,22 @@ def multi_preview(image, size=None, out_path=None, palette_mode='all', factor=0.
             9:  'High contrast (effect=9)'
             }
 
-  n = 0
-  for row in axs:
-    for ax in row:
-      previews[n] = palette_thumbnail(previews[n], size=(size_x, size_y), palette_mode=palette_mode, dither=False) #========================================================#
-      ax.axis('off')
-      ax.imshow(previews[n])
-      ax.set_title(titles[n])
-      n += 1
-
-  plt.tight_layout(rect=[0, 0.05, 1, 0.98])  
-  if out_path:
-      plt.savefig(out_path, bbox_inches='tight')
-  plt.close()
+  for palette_mode, out_path in out_paths.items():
+    fig, axs = plt.subplots(5,2, figsize=(10, 20), dpi=40)
+    plt.subplots_adjust(wspace=0.1, hspace=0)
+    plt.suptitle(f'Palette: {palette_mode.upper()}', va='bottom') 
+    n = 0
+    for row in axs:
+      for ax in row:
+        ax.axis('off')
+        ax.imshow(thumbnails[n][palette_mode])
+        ax.set_title(titles[n])
+        n += 1
+
+    plt.tight_layout(rect=[0, 0.05, 1, 0.98])  
+    if out_path:
+        plt.savefig(out_path, bbox_inches='tight')
+    plt.close()
 
 def default_preview(image, factor):
   ''' Generate default previews of the image applying different effects '''
@@ -277,23 +783,17 @@ def default_preview(image, factor):
 
 def auto_color_replace(image, palette_mode, out_path):
     ''' Count the pixels for each color in the pallette and replace rare colors. '''
-    colors = palettes.LEGOS[palette_mode]
+    palette = palettes.get_palette(palette_mode)
     substitutes = palettes.substitutes
     color_count = image.histogram()
-    colors_to_replace = []
-    
-    for i in range(len(colors)):
+    colors_to_replace = {}
+
+    for i, color in enumerate(palette.letters):
         if 0 < color_count[i] < 3:
-            color = list(colors.keys())[i]
-            colors_to_replace.append(color)
-  
+            colors_to_replace[color] = substitutes[color]
+
     data = np.array(image)
-    for ny, y in enumerate(data):
-        for nx, x in enumerate(data[ny]):
-            index_letter = list(colors.keys())[x]
-            if index_letter in colors_to_replace:
-                x = list(colors.keys()).index(substitutes[index_letter])
-                image.putpixel((nx, ny), x)
+    image.frombytes(palette.replacement_map(colors_to_replace)[data].tobytes())
     if 1 in color_count:
         print('The replace operation was skipped.') 
     else:           
@@ -301,14 +801,9 @@ def auto_color_replace(image, palette_mode, out_path):
         
 def manual_color_replace(image, colors_to_replace, palette_mode, out_path):
     ''' The 'colors_to_replace' parameter takes a dictionary of '{old : new}' values as input. '''
-    colors = palettes.LEGOS[palette_mode]    
+    palette = palettes.get_palette(palette_mode)
     data = np.array(image)
-    for ny, y in enumerate(data):
-        for nx, x in enumerate(data[ny]):
-            index_letter = list(colors.keys())[x]
-            if index_letter in colors_to_replace.keys():
-                x = list(colors.keys()).index(colors_to_replace[index_letter])
-                image.putpixel((nx, ny), x)
+    image.frombytes(palette.replacement_map(colors_to_replace)[data].tobytes())
 
     image.save(out_path)     
 
@@ -337,7 +832,7 @@ def instructions_by_quadrant(image, out_path, range_x, range_y, unit, quadrant_n
   plt.figure(figsize=(20, 20))
   for y in range(range_y[0], range_y[1]):
     for x in range(range_x[0], range_x[1]):
-      color_label = list(palettes.LEGOS[palette_mode].keys())[image.getpixel((x, y))]
+      color_label = palettes.get_palette(palette_mode).letters[image.getpixel((x, y))]
       txt = plt.text(x % unit, y % unit, color_label, ha="center", va="center", color='k', fontsize=12)
       txt.set_path_effects([effects.withStroke(linewidth=3, foreground='w')])
   ax = plt.gca()
@@ -360,18 +855,24 @@ def instructions(image, palette_mode, out_path):
       instructions_by_quadrant(image, out_path, (quadrant_x * unit, quadrant_x * unit + unit), (quadrant_y * unit, quadrant_y * unit + unit), unit, quadrant_n, palette_mode)
       quadrant_n += 1
 
+def available_bricks(stock, log_path='brick_quantity_log.csv'):
+    ''' Bricks left of each color, from the {letter: bricks} in stock minus the quantities
+    already used in the brick quantity log. The result is the limits of pre_process. '''
+    log_file = pd.read_csv(log_path, index_col=0)
+    return dict((color, bricks - (int(log_file.loc[color, 'quantity']) if color in log_file.index else 0))
+                for color, bricks in stock.items())
+
 def color_count_printer(image, palette_mode, out_path):
     ''' Count the bricks needed for each color in the pallette and print the required brick quantities. '''
     print('Creating brick quantity requirements and adding them to the log')
     instructions = open(out_path, 'w')
-    colors = palettes.LEGOS[palette_mode]
+    palette = palettes.get_palette(palette_mode)
     color_count = image.histogram()
     log_file  = pd.read_csv('brick_quantity_log.csv', index_col=0)    
 
     instructions.write('Here is what you need:\n\n')
-    for i in range(len(colors)):
+    for i, color in enumerate(palette.letters):
         if color_count[i] > 0:
-            color = list(colors.keys())[i]
             old_log_value = log_file.loc[color, 'quantity']
             log_file.loc[color, 'quantity'] = old_log_value + color_count[i]
             instructions.write (f'Color {color}: {color_count[i]} bricks\n')
@@ -380,12 +881,48 @@ def color_count_printer(image, palette_mode, out_path):
     
 # =================  APPLY LEGO EFFECT  ================= #    
     
-def legofy(thumbnail_image, brick_image, destination):
+def legofy(thumbnail_image, brick_image, destination, brick_size=None):
     destination = os.path.join(destination, 'lego_' + os.path.basename(thumbnail_image))
     print(destination)
     image = Image.open(thumbnail_image)
-    brick = Image.open(brick_image)
-    final_image = make_lego_image(image, brick)
+    brick = load_brick(brick_image)
+    final_image = make_lego_image(image, brick, brick_size=brick_size)
     final_image.save(destination)
-        
-    
\ No newline at end of file
+
+
+def _render_quadrant(task):
+    thumbnail_image, brick_image, out_path = task
+    make_lego_image(thumbnail_image, brick_image).save(out_path)
+
+def legofy_by_quadrant(thumbnail_image, brick_image, out_path, workers=1):
+    '''Render one lego image per baseplate quadrant, numbered like the instructions, and write an index
+    file (same name as out_path, .json extension) describing how the quadrants are reassembled.'''
+    quadrants_x, quadrants_y, unit = count_quadrants(thumbnail_image)
+    brick_width, brick_height = brick_image.size
+    quadrants = []
+    tasks = []
+    quadrant_n = 1
+    for quadrant_y in range(quadrants_y):
+        for quadrant_x in range(quadrants_x):
+            box = (quadrant_x * unit, quadrant_y * unit, quadrant_x * unit + unit, quadrant_y * unit + unit)
+            quadrant_path = os.path.join(os.path.dirname(out_path), f'{quadrant_n}_{os.path.basename(out_path)}')
+            quadrants.append({'quadrant': quadrant_n, 'file': os.path.basename(quadrant_path),
+                              'column': quadrant_x, 'row': quadrant_y,
+                              'box': [box[0] * brick_width, box[1] * brick_height,
+                                      box[2] * brick_width, box[3] * brick_height]})
+            tasks.append((thumbnail_image.crop(box), brick_image, quadrant_path))
+            quadrant_n += 1
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_render_quadrant, tasks))
+    else:
+        for task in tasks:
+            _render_quadrant(task)
+    index = {'unit': unit, 'quadrants_x': quadrants_x, 'quadrants_y': quadrants_y,
+             'brick_size': [brick_width, brick_height],
+             'size': [quadrants_x * unit * brick_width, quadrants_y * unit * brick_height],
+             'quadrants': quadrants}
+    index_path = os.path.splitext(out_path)[0] + '.json'
+    with open(index_path, 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+    return index_path
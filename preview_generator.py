@@ -30,10 +30,11 @@ def generate_previews():
             if not os.path.exists(previews_folder_path):
                 os.makedirs(previews_folder_path)
             image = Image.open(in_path)
+            previews_file_paths = {}
             for palette in palettes:
-                previews_file_path = os.path.join(previews_folder_path, 
-                                                  f'Previews_{palette[:2].upper()}_{os.path.splitext(file)[0]}.pdf')
-                lego.multi_preview(image, size, previews_file_path, palette, factor)
+                previews_file_paths[palette] = os.path.join(previews_folder_path, 
+                                                            f'Previews_{palette[:2].upper()}_{os.path.splitext(file)[0]}.pdf')
+            lego.multi_palette_preview(image, size, previews_file_paths, factor)
 
 generate_previews()
 
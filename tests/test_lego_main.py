@@ -0,0 +1,626 @@
+'''Unit tests for lego_main'''
+# They can be run individually, for example:
+# python -m pytest tests/test_lego_main.py -k Render
+import base64
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+import lego_main as lego
+from lego import dither, palettes, quantize, resample
+from lego.cache import BufferPool, LRUCache, bricks as brick_cache, buffers
+
+TEST_DIR = os.path.realpath(os.path.dirname(__file__))
+BRICK_PATH = os.path.join(TEST_DIR, '..', 'lego', 'assets', 'bricks', '1x1.png')
+
+CACHE_DIR = None
+# restores the environment, including a LEGO_CACHE_DIR set before the tests
+ENVIRON = mock.patch.dict(os.environ)
+
+
+def setUpModule():
+    '''Keep the lookup tables built by the tests out of the user's cache'''
+    global CACHE_DIR
+    CACHE_DIR = tempfile.mkdtemp(prefix='lego_cache_')
+    ENVIRON.start()
+    os.environ['LEGO_CACHE_DIR'] = CACHE_DIR
+
+
+def tearDownModule():
+    ENVIRON.stop()
+    shutil.rmtree(CACHE_DIR)
+
+
+def make_gradient(width=12, height=9):
+    '''Builds a small RGB test image with plenty of distinct colors'''
+    x, y = np.meshgrid(np.linspace(0, 255, width), np.linspace(0, 255, height))
+    data = np.dstack([x, y, 255 - (x + y) / 2]).astype(np.uint8)
+    return Image.fromarray(data, 'RGB')
+
+
+def reference_lego_image(thumbnail_image, brick_image):
+    '''Per-cell rendering, as make_lego_image originally did it'''
+    base_width, base_height = thumbnail_image.size
+    brick_width, brick_height = brick_image.size
+    rgb_image = thumbnail_image.convert('RGB')
+    lego_image = Image.new("RGB", (base_width * brick_width, base_height * brick_height), "white")
+    for brick_x in range(base_width):
+        for brick_y in range(base_height):
+            color = rgb_image.getpixel((brick_x, brick_y))
+            lego_image.paste(lego.apply_color_overlay(brick_image, color),
+                             (brick_x * brick_width, brick_y * brick_height))
+    return lego_image
+
+
+class Render(unittest.TestCase):
+    '''Make sure the fast render paths match the per-cell overlay'''
+
+    def setUp(self):
+        self.brick = Image.open(BRICK_PATH)
+        self.thumbnail = lego.apply_thumbnail_effects(make_gradient(), lego.get_lego_palette('solid'))
+
+    def tearDown(self):
+        self.brick.close()
+
+    def assertSameImage(self, first, second):
+        self.assertEqual(first.size, second.size)
+        self.assertTrue(np.array_equal(np.asarray(first.convert('RGB')), np.asarray(second.convert('RGB'))))
+
+    def test_indexed_render(self):
+        '''Palette thumbnails are rendered from one tinted brick per color'''
+        self.assertEqual(self.thumbnail.mode, 'P')
+        self.assertSameImage(lego.make_lego_image(self.thumbnail, self.brick),
+                             reference_lego_image(self.thumbnail, self.brick))
+
+    def test_rgb_render(self):
+        '''Free color thumbnails are overlaid in a single array operation'''
+        thumbnail = make_gradient()
+        self.assertSameImage(lego.make_lego_image(thumbnail, self.brick),
+                             reference_lego_image(thumbnail, self.brick))
+
+    def test_banded_render(self):
+        '''Renders are built a band of brick rows at a time, never as full canvas arrays'''
+        for thumbnail in (self.thumbnail, make_gradient()):
+            grid, bricks = lego.get_lego_grid(thumbnail, self.brick)
+            self.assertSameImage(lego.make_banded_lego_image(grid, bricks, band_bytes=1),
+                                 reference_lego_image(thumbnail, self.brick))
+        for thumbnail in (make_gradient(96, 96), lego.apply_thumbnail_effects(make_gradient(96, 96),
+                                                                               lego.get_lego_palette('solid'))):
+            buffers.clear()
+            tracemalloc.start()
+            try:
+                lego_image = lego.make_lego_image(thumbnail, self.brick)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            canvas_bytes = lego_image.size[0] * lego_image.size[1] * 3
+            self.assertLess(peak, 3 * lego.BAND_BYTES + canvas_bytes // 4)
+
+    def test_brick_size(self):
+        '''Preview renders use a brick resampled once to the requested size'''
+        preview = lego.make_lego_image(self.thumbnail, self.brick, brick_size=8)
+        self.assertEqual(preview.size, (self.thumbnail.size[0] * 8, self.thumbnail.size[1] * 8))
+        small_brick = lego.resize_brick(self.brick, 8)
+        self.assertSameImage(preview, reference_lego_image(self.thumbnail, small_brick))
+
+    def test_indexed_output(self):
+        '''Palette renders can be encoded as P mode images'''
+        small_brick = lego.resize_brick(self.brick, 4)
+        indexed = lego.make_lego_image(self.thumbnail, small_brick, indexed=True)
+        self.assertEqual(indexed.mode, 'P')
+        self.assertSameImage(indexed, lego.make_lego_image(self.thumbnail, small_brick))
+        # the full size brick has too many shades for 256 colors: RGB, unless they may be reduced
+        indexed = lego.make_lego_image(self.thumbnail, self.brick, indexed=True)
+        self.assertEqual(indexed.mode, 'RGB')
+        self.assertSameImage(indexed, lego.make_lego_image(self.thumbnail, self.brick))
+        indexed = lego.make_lego_image(self.thumbnail, self.brick, indexed=True, shading_levels=8)
+        self.assertEqual(indexed.mode, 'P')
+        self.assertLessEqual(len(indexed.getcolors()), 8 * 15)
+        self.assertEqual(indexed.size, lego.make_lego_image(self.thumbnail, self.brick).size)
+        out_dir = tempfile.mkdtemp(prefix='lego_')
+        try:
+            out_path = os.path.join(out_dir, 'lego.png')
+            lego.legofy_image(make_gradient(), self.brick, out_path, 12, 'solid', False, brick_size=4, indexed=True)
+            with Image.open(out_path) as lego_image:
+                self.assertEqual(lego_image.mode, 'P')
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_transparent_cells(self):
+        '''Cells below the alpha threshold get no brick and stay transparent'''
+        cutout = make_gradient().convert('RGBA')
+        alpha = np.zeros(cutout.size[::-1], dtype=np.uint8)
+        alpha[2:6, 3:9] = 255
+        cutout.putalpha(Image.fromarray(alpha, 'L'))
+        mask = lego.get_brick_mask(cutout)
+        for thumbnail in (cutout.convert('RGB'), lego.apply_thumbnail_effects(cutout.convert('RGB'),
+                                                                              lego.get_lego_palette('solid'))):
+            lego_image = lego.make_lego_image(thumbnail, self.brick, mask=mask)
+            self.assertEqual(lego_image.mode, 'RGBA')
+            rendered = np.asarray(lego_image)
+            expected = np.asarray(reference_lego_image(thumbnail, self.brick))
+            self.assertTrue(np.array_equal(rendered[60:180, 90:270, :3], expected[60:180, 90:270]))
+            self.assertTrue((rendered[60:180, 90:270, 3] == 255).all())
+            self.assertEqual(int(rendered[:, :, 3].sum()), 255 * 24 * 30 * 30)
+        self.assertEqual(lego.get_brick_mask(make_gradient()), None)
+
+    def test_incremental_update(self):
+        '''Patching the replaced cells gives the same image as a full render'''
+        previous = self.thumbnail.copy()
+        lego_image = lego.make_lego_image(previous, self.brick)
+        for cell in ((0, 0), (5, 7)):
+            self.thumbnail.putpixel(cell, (previous.getpixel(cell) + 1) % 15)
+        rows, columns = lego.get_changed_cells(previous, self.thumbnail)
+        self.assertEqual(sorted(zip(rows.tolist(), columns.tolist())), [(0, 0), (7, 5)])
+        self.assertSameImage(lego.update_lego_image(lego_image, previous, self.thumbnail, self.brick),
+                             lego.make_lego_image(self.thumbnail, self.brick))
+
+    def test_progressive_render(self):
+        '''Progressive renders go from flat colors to the full image'''
+        for thumbnail in (self.thumbnail, make_gradient()):
+            stages = list(lego.iter_progressive_lego_images(thumbnail, self.brick, preview_brick_size=8))
+            self.assertEqual([stage.size[0] for stage in stages], [12, 96, 360])
+            self.assertSameImage(stages[0], thumbnail)
+            self.assertSameImage(stages[-1], lego.make_lego_image(thumbnail, self.brick))
+
+    def test_parallel_render(self):
+        '''Bands rendered by a process pool match the serial render byte for byte'''
+        for thumbnail in (self.thumbnail, make_gradient()):
+            self.assertSameImage(lego.make_lego_image(thumbnail, self.brick, workers=2, band_height=2),
+                                 lego.make_lego_image(thumbnail, self.brick))
+
+
+class Streaming(unittest.TestCase):
+    '''Test the band by band writers'''
+
+    def setUp(self):
+        self.brick = Image.open(BRICK_PATH)
+        self.thumbnail = lego.apply_thumbnail_effects(make_gradient(), lego.get_lego_palette('solid'))
+        self.out_dir = tempfile.mkdtemp(prefix='lego_')
+
+    def tearDown(self):
+        self.brick.close()
+        shutil.rmtree(self.out_dir)
+
+    def test_streamed_formats(self):
+        '''Streamed files decode to the same pixels as the in-memory render'''
+        expected = np.asarray(lego.make_lego_image(self.thumbnail, self.brick))
+        for extension in ('.png', '.tif', '.ppm'):
+            out_path = os.path.join(self.out_dir, 'streamed' + extension)
+            lego.save_lego_image(self.thumbnail, self.brick, out_path, band_height=2)
+            with Image.open(out_path) as streamed:
+                self.assertTrue(np.array_equal(np.asarray(streamed.convert('RGB')), expected), extension)
+        # filtered scanlines keep streamed PNGs close to the size PIL writes
+        pil_path = os.path.join(self.out_dir, 'pil.png')
+        Image.fromarray(expected, 'RGB').save(pil_path)
+        self.assertLess(os.path.getsize(os.path.join(self.out_dir, 'streamed.png')), 1.5 * os.path.getsize(pil_path))
+
+    def test_deep_zoom_pyramid(self):
+        '''The finest pyramid level is cut from the full render and every tile has its box size'''
+        expected = np.asarray(lego.make_lego_image(self.thumbnail, self.brick))
+        pyramid = lego.save_lego_pyramid(self.thumbnail, self.brick, os.path.join(self.out_dir, 'mosaic.dzi'),
+                                         tile_size=64)
+        for level in range(pyramid.levels):
+            columns, rows = pyramid.tile_count(level)
+            for column in range(columns):
+                for row in range(rows):
+                    left, upper, right, lower = pyramid.tile_box(level, column, row)
+                    tile_path = os.path.join(self.out_dir, 'mosaic_files', str(level), '{0}_{1}.png'.format(column, row))
+                    with Image.open(tile_path) as tile:
+                        self.assertEqual(tile.size, (right - left, lower - upper))
+                        if level == pyramid.max_level:
+                            self.assertTrue(np.array_equal(np.asarray(tile), expected[upper:lower, left:right]))
+
+    def test_quadrant_shards(self):
+        '''Every baseplate is rendered on its own and the index reassembles the full image'''
+        thumbnail = lego.apply_thumbnail_effects(make_gradient(64, 40), lego.get_lego_palette('solid'))
+        brick = lego.resize_brick(self.brick, 4)
+        index_path = lego.legofy_by_quadrant(thumbnail, brick, os.path.join(self.out_dir, 'mosaic.png'), workers=2)
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        self.assertEqual((index['unit'], len(index['quadrants'])), (32, 2))
+        assembled = Image.new('RGB', tuple(index['size']))
+        for quadrant in index['quadrants']:
+            with Image.open(os.path.join(self.out_dir, quadrant['file'])) as shard:
+                assembled.paste(shard, tuple(quadrant['box'][:2]))
+        self.assertTrue(np.array_equal(np.asarray(assembled),
+                                       np.asarray(lego.make_lego_image(thumbnail.crop((0, 0, 64, 32)), brick))))
+
+    def test_vector_output(self):
+        '''Vector files hold one brick per color and one rectangle per run of equal bricks'''
+        svg_path = os.path.join(self.out_dir, 'mosaic.svg')
+        lego.save_vector_lego_image(self.thumbnail, self.brick, svg_path)
+        grid = np.asarray(self.thumbnail)
+        runs = int((grid[:, 1:] != grid[:, :-1]).sum()) + grid.shape[0]
+        with open(svg_path) as svg:
+            document = svg.read()
+        self.assertEqual(document.count('<pattern '), len(np.unique(grid)))
+        self.assertEqual(document.count('<rect '), runs)
+        pdf_path = os.path.join(self.out_dir, 'mosaic.pdf')
+        lego.save_vector_lego_image(self.thumbnail, self.brick, pdf_path)
+        with open(pdf_path, 'rb') as pdf:
+            self.assertTrue(pdf.read().startswith(b'%PDF-1.4'))
+        self.assertRaises(ValueError, lego.save_vector_lego_image, make_gradient(), self.brick, pdf_path)
+
+    def test_tinted_vector_output(self):
+        '''Free colors store the brick once, its shading added to the fills gives the raster render'''
+        svg_path = os.path.join(self.out_dir, 'tinted.svg')
+        thumbnail = make_gradient()
+        lego.save_vector_lego_image(thumbnail, self.brick, svg_path)
+        with open(svg_path) as svg:
+            document = svg.read()
+        self.assertEqual(document.count('<pattern '), 0)
+        self.assertEqual(document.count('<feImage '), 1)
+        encoded = re.search(r'base64,([^"]+)', document).group(1)
+        shading = np.asarray(Image.open(io.BytesIO(base64.b64decode(encoded))), dtype=np.int16)
+        fills = re.findall(r'fill="#([0-9a-f]{6})"', document)
+        self.assertEqual(len(fills), thumbnail.size[0] * thumbnail.size[1])
+        colors = np.array([[int(fill[n:n + 2], 16) for n in (0, 2, 4)] for fill in fills]).reshape(9, 12, 1, 1, 3)
+        tinted = np.clip(colors + shading - 133, 0, 255).astype(np.uint8).transpose(0, 2, 1, 3, 4)
+        brick_height, brick_width = shading.shape[:2]
+        self.assertTrue(np.array_equal(tinted.reshape(9 * brick_height, 12 * brick_width, 3),
+                                       np.asarray(lego.make_lego_image(thumbnail, self.brick))))
+
+    def test_unsupported_format(self):
+        '''Formats that cannot be written incrementally are refused'''
+        out_path = os.path.join(self.out_dir, 'streamed.jpg')
+        self.assertRaises(ValueError, lego.save_lego_image, self.thumbnail, self.brick, out_path)
+
+
+class Palettes(unittest.TestCase):
+    '''Test the compiled palettes and their users'''
+
+    def test_compiled_once(self):
+        '''Every palette name is compiled once and matches the flat palettes'''
+        legos = palettes.legos()
+        for name in legos:
+            palette = palettes.get_palette(name)
+            self.assertIs(palette, palettes.get_palette(name))
+            self.assertEqual(list(palette.flat), palettes.extend_palette(legos[name]))
+            self.assertEqual([palette.index(letter) for letter in palette.letters], list(range(len(palette))))
+        self.assertRaises(ValueError, palettes.get_palette('art').index, 'A')
+
+    def test_manual_color_replace(self):
+        '''Replaced letters are remapped in place and the rest is left alone'''
+        image = lego.apply_thumbnail_effects(make_gradient(), palettes.get_palette('solid'))
+        before = np.array(image)
+        handle, out_path = tempfile.mkstemp(prefix='lego_', suffix='.png')
+        os.close(handle)
+        try:
+            lego.manual_color_replace(image, {'A': 'E', 'Z': 'B'}, 'solid', out_path)
+        finally:
+            os.remove(out_path)
+        after = np.asarray(image)
+        self.assertTrue(np.array_equal(after, np.where(before == 0, 4, before)))
+
+
+class Quantize(unittest.TestCase):
+    '''Test the NumPy quantization engines'''
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='lego_')
+        os.environ['LEGO_CACHE_DIR'] = self.cache_dir
+        self.pixels = np.random.RandomState(0).randint(0, 256, (64, 64, 3)).astype(np.uint8)
+
+    def tearDown(self):
+        os.environ['LEGO_CACHE_DIR'] = CACHE_DIR
+        shutil.rmtree(self.cache_dir)
+
+    def test_lookup_table_matches_pil(self):
+        '''The 6 bit lookup table reproduces PIL's palette conversion'''
+        palette = palettes.Palette('solid', palettes.LEGOS['solid'])
+        image = Image.fromarray(self.pixels, 'RGB')
+        expected = np.asarray(lego.quantize_to_palette(image, palette.image, False))
+        self.assertTrue(np.array_equal(quantize.quantize_array(self.pixels, palette), expected))
+        self.assertTrue(os.listdir(self.cache_dir))
+        # a fresh palette with the same colors loads the table back from disk
+        reloaded = palettes.Palette('solid', palettes.LEGOS['solid'])
+        self.assertTrue(np.array_equal(quantize.color_lookup_table(reloaded), quantize.color_lookup_table(palette)))
+
+    def test_refined_lookup_is_exact(self):
+        '''Refinement gives the exact nearest color at any bit depth'''
+        palette = palettes.Palette('portrait', palettes.LEGOS['portrait'])
+        exact = quantize.nearest_indices(self.pixels, palette)
+        for bits in (5, 6):
+            refined = quantize.quantize_array(self.pixels, palette, bits=bits, refine=True)
+            self.assertTrue(np.array_equal(refined, exact))
+
+    def test_perceptual_metrics(self):
+        '''Lab lookups agree with the exact Lab nearest color for the refined pixels'''
+        palette = palettes.Palette('portrait', palettes.LEGOS['portrait'])
+        for metric in ('de76', 'de2000'):
+            exact = quantize.nearest_indices(self.pixels, palette, metric)
+            looked_up = quantize.quantize_array(self.pixels, palette, metric=metric)
+            self.assertGreater((looked_up == exact).mean(), 0.95)
+        refined = quantize.quantize_array(self.pixels, palette, refine=True, metric='de76')
+        self.assertTrue(np.array_equal(refined, quantize.nearest_indices(self.pixels, palette, 'de76')))
+        # a reference CIEDE2000 pair from Sharma, Wu and Dalal
+        distance = quantize.delta_e2000(np.array([[50.0, 2.6772, -79.7751]]), np.array([[50.0, 0.0, -82.7485]]))
+        self.assertAlmostEqual(distance[0, 0], 2.0425, places=4)
+        thumbnail = lego.apply_thumbnail_effects(Image.fromarray(self.pixels, 'RGB'), palette, metric='de2000')
+        self.assertEqual(thumbnail.mode, 'P')
+
+    def test_gray_palette(self):
+        '''Palettes of grays are digitized from one value per pixel, without 3D tables'''
+        palette = palettes.Palette('bw', palettes.LEGOS['bw'])
+        self.assertTrue(np.array_equal(quantize.gray_levels(palette), [0, 60, 110, 180, 255]))
+        self.assertEqual(quantize.gray_levels(palettes.get_palette('solid')), None)
+        expected = np.asarray(lego.quantize_to_palette(Image.fromarray(self.pixels, 'RGB'), palette.image, False))
+        self.assertTrue(np.array_equal(quantize.quantize_array(self.pixels, palette), expected))
+        for metric in ('rgb', 'de76'):
+            self.assertTrue(np.array_equal(quantize.quantize_array(self.pixels, palette, refine=True, metric=metric),
+                                           quantize.nearest_indices(self.pixels, palette, metric)))
+        self.assertFalse(any(name.startswith('lut') for name in palette.lookups))
+        self.assertRaises(ValueError, quantize.quantize_gray, self.pixels, palette, metric='de2000')
+        flat = np.full((16, 16, 3), 90, dtype=np.uint8)
+        self.assertEqual(sorted(np.unique(dither.ordered(flat, palette, 'bayer8')).tolist()), [1, 2])
+
+    def test_multi_palette(self):
+        '''One pass over several palettes gives each palette's own quantization'''
+        names = ('art', 'portrait', 'solid')
+        palette_list = [palettes.get_palette(name) for name in names]
+        grids = quantize.quantize_palettes(self.pixels, palette_list)
+        for palette, grid in zip(palette_list, grids):
+            self.assertTrue(np.array_equal(grid, quantize.quantize_array(self.pixels, palette)))
+        refined = quantize.quantize_palettes(self.pixels, palette_list[:2], bits=5, refine=True)
+        exact = quantize.nearest_indices_multi(self.pixels, palette_list[:2])
+        self.assertTrue(all(np.array_equal(grid, expected) for grid, expected in zip(refined, exact)))
+        exact = quantize.nearest_indices_multi(self.pixels, palette_list, 'de76')
+        self.assertTrue(np.array_equal(exact[0], quantize.nearest_indices(self.pixels, palette_list[0], 'de76')))
+        thumbnails = lego.palette_thumbnails(Image.fromarray(self.pixels, 'RGB'), (32, 32), names)
+        for name in names:
+            expected = lego.palette_thumbnail(Image.fromarray(self.pixels, 'RGB'), (32, 32), name)
+            self.assertTrue(np.array_equal(np.asarray(thumbnails[name]), np.asarray(expected)))
+        out_paths = dict((name, os.path.join(self.cache_dir, name + '.pdf')) for name in names[:2])
+        lego.multi_palette_preview(Image.fromarray(self.pixels, 'RGB'), (16, 16), out_paths)
+        self.assertTrue(all(os.path.isfile(out_path) for out_path in out_paths.values()))
+
+    def test_batch(self):
+        '''Batches give the same grids as quantizing every image on its own'''
+        palette = palettes.get_palette('solid')
+        stacked = np.stack([self.pixels, self.pixels[::-1]])
+        self.assertTrue(np.array_equal(quantize.quantize_batch(stacked, palette)[1],
+                                       quantize.quantize_array(self.pixels[::-1], palette)))
+        images = [self.pixels, self.pixels[:40, :24]]
+        for grid, pixels in zip(quantize.quantize_batch(images, palette), images):
+            self.assertTrue(np.array_equal(grid, quantize.quantize_array(pixels, palette)))
+        self.assertEqual(quantize.quantize_batch([], palette), [])
+        # pre processed images are quantized in one batch per palette
+        settings = [dict(size=(48, 48), palette_mode='solid', effect=1),
+                    dict(size=(40, 40), palette_mode='bw', contrast=0.5),
+                    dict(size=(48, 48), palette_mode='solid', color=0.3)]
+        sources = [Image.fromarray(self.pixels, 'RGB'), Image.fromarray(self.pixels, 'RGB').convert('L'),
+                   Image.fromarray(self.pixels[::-1], 'RGB')]
+        batch = lego.pre_process_batch([source.copy() for source in sources], settings)
+        for processed, source, image_settings in zip(batch, sources, settings):
+            expected = lego.pre_process(source.copy(), **image_settings)
+            self.assertEqual(processed.size, expected.size)
+            self.assertTrue(np.array_equal(np.asarray(processed), np.asarray(expected)))
+
+    def test_brick_limits(self):
+        '''Limited colors never exceed their budget and the other cells keep their nearest color'''
+        palette = palettes.get_palette('solid')
+        nearest = quantize.nearest_indices(self.pixels, palette)
+        unlimited = np.full(len(palette), np.inf)
+        self.assertTrue(np.array_equal(quantize.constrained_indices(self.pixels, palette, unlimited), nearest))
+        limits = {'E': 10, 'L': 0, 'Z': 5}
+        counts = np.bincount(nearest.ravel(), minlength=len(palette))
+        constrained = quantize.constrained_indices(self.pixels, palette, palette.limit_array(limits))
+        used = np.bincount(constrained.ravel(), minlength=len(palette))
+        self.assertEqual(used[palette.index('E')], 10)
+        self.assertEqual(used[palette.index('L')], 0)
+        # only the cells over budget move
+        self.assertEqual(int((constrained != nearest).sum()),
+                         counts[palette.index('E')] - 10 + counts[palette.index('L')])
+        self.assertRaises(ValueError, quantize.constrained_indices, self.pixels, palette, np.zeros(len(palette)))
+        thumbnail = lego.apply_thumbnail_effects(Image.fromarray(self.pixels, 'RGB'), palette, limits=limits)
+        self.assertTrue(np.array_equal(np.asarray(thumbnail), constrained))
+        log_path = os.path.join(self.cache_dir, 'brick_quantity_log.csv')
+        with open(log_path, 'w') as log_file:
+            log_file.write('color,quantity\nE,40\nL,3\n')
+        self.assertEqual(lego.available_bricks({'E': 50, 'H': 20}, log_path), {'E': 10, 'H': 20})
+
+    def test_error_diffusion(self):
+        '''Tiled error diffusion does not depend on the number of workers'''
+        palette = palettes.get_palette('solid')
+        for kernel in sorted(dither.KERNELS):
+            serial = dither.diffuse(self.pixels, palette, kernel, tile_size=16)
+            self.assertEqual(serial.dtype, np.uint8)
+            self.assertLess(serial.max(), len(palette))
+            self.assertTrue(np.array_equal(dither.diffuse(self.pixels, palette, kernel, tile_size=16, workers=2),
+                                           serial))
+        # the error spreads the mean color closer than plain nearest colors
+        diffused = palette.colors[dither.diffuse(self.pixels, palette)].mean(axis=(0, 1))
+        nearest = palette.colors[quantize.nearest_indices(self.pixels, palette)].mean(axis=(0, 1))
+        target = self.pixels.mean(axis=(0, 1))
+        self.assertLess(np.abs(diffused - target).sum(), np.abs(nearest - target).sum())
+        self.assertRaises(ValueError, dither.diffuse, self.pixels, palette, 'ordered')
+        thumbnail = lego.apply_thumbnail_effects(Image.fromarray(self.pixels, 'RGB'), palette, dither='atkinson')
+        self.assertEqual(thumbnail.mode, 'P')
+
+    def test_ordered_dithering(self):
+        '''Ordered patterns only depend on the pixel position, so bands and frames stay seamless'''
+        palette = palettes.get_palette('solid')
+        self.assertEqual(sorted(np.unique(dither.bayer_matrix(8)).tolist()), list(range(64)))
+        for pattern in sorted(dither.PATTERNS):
+            indices = dither.ordered(self.pixels, palette, pattern)
+            self.assertTrue(np.array_equal(dither.ordered(self.pixels, palette, pattern, band_height=5, workers=3),
+                                           indices))
+            # a change in one corner of the next frame leaves every other brick alone
+            frame = self.pixels.copy()
+            frame[:8, :8] = 0
+            changed = dither.ordered(frame, palette, pattern) != indices
+            self.assertFalse(changed[8:].any() or changed[:, 8:].any())
+        flat = np.full((16, 16, 3), 100, dtype=np.uint8)
+        self.assertGreater(len(np.unique(dither.ordered(flat, palette, 'bayer4'))), 1)
+        self.assertRaises(ValueError, dither.ordered, self.pixels, palette, 'bayer3')
+        thumbnail = lego.palette_thumbnail(Image.fromarray(self.pixels, 'RGB'), (32, 32), 'solid', dither='blue-noise')
+        self.assertEqual(thumbnail.mode, 'P')
+
+
+class Resample(unittest.TestCase):
+    '''Test the reductions to the brick grid'''
+
+    def setUp(self):
+        self.pixels = np.random.RandomState(0).randint(0, 256, (37, 53, 3)).astype(np.uint8)
+        self.out_dir = tempfile.mkdtemp(prefix='lego_')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_thumbnail_size(self):
+        '''Grids have the size PIL's thumbnail gives'''
+        for image_size, size in (((53, 37), (20, 20)), ((37, 53), (20, 20)), ((600, 400), (64, 64)),
+                                 ((640, 480), (500, 30)), ((50, 40), (64, 64))):
+            image = Image.new('RGB', image_size)
+            image.thumbnail(size)
+            self.assertEqual(resample.thumbnail_size(image_size, size), image.size)
+
+    def test_resampling_paths(self):
+        '''Thumbnails match PIL's own and report the reductions taken before the filter'''
+        image = Image.fromarray(self.pixels, 'RGB').resize((530, 370), Image.BILINEAR)
+        for resample_filter in ('bicubic', 'lanczos'):
+            expected = image.copy()
+            expected.thumbnail((20, 20), resample.FILTERS[resample_filter])
+            thumbnail, path = resample.thumbnail(image, (20, 20), resample_filter)
+            self.assertEqual(path, 'reduce 13x13 + ' + resample_filter)
+            self.assertTrue(np.array_equal(np.asarray(thumbnail), np.asarray(expected)))
+        self.assertEqual(image.size, (530, 370))
+        self.assertEqual(resample.thumbnail(image, (53, 37), 'box')[1], 'reduce 10x10')
+        self.assertEqual(resample.thumbnail(image, (600, 600))[1], 'none')
+        self.assertRaises(ValueError, resample.thumbnail, image, (20, 20), 'antialias')
+        jpeg_path = os.path.join(self.out_dir, 'source.jpg')
+        image.save(jpeg_path)
+        with Image.open(jpeg_path) as jpeg:
+            self.assertEqual(resample.thumbnail(jpeg, (20, 20), 'lanczos')[1], 'reduce 13x13 + lanczos')
+            self.assertEqual(jpeg.size, (530, 370))
+        with Image.open(jpeg_path) as jpeg:
+            self.assertTrue(resample.thumbnail(jpeg, (20, 20), 'lanczos', draft=True)[1].startswith('draft '))
+            self.assertLess(jpeg.size, (530, 370))
+        for mode in ('P', '1'):
+            thumbnail, path = resample.thumbnail(image.convert(mode), (53, 37), 'box')
+            self.assertEqual((thumbnail.mode, thumbnail.size, path), (mode, (53, 37), 'nearest'))
+        # the default legofy path no longer relies on Image.ANTIALIAS
+        out_path = os.path.join(self.out_dir, 'lego.png')
+        path = lego.legofy_image(image, lego.resize_brick(Image.open(BRICK_PATH), 4), out_path, 20, 'solid', False)
+        self.assertTrue(path.endswith('lanczos'))
+        with Image.open(out_path) as lego_image:
+            self.assertEqual(lego_image.size, (80, 56))
+
+    def test_block_reductions(self):
+        '''Uneven blocks give the mean, lower median and majority of their own pixels'''
+        indices = np.random.RandomState(1).randint(0, 4, self.pixels.shape[:2])
+        # sizes that divide give blocks of 7x7 pixels, the mean is computed by PIL
+        mean = np.asarray(resample.block_mean(Image.fromarray(self.pixels[:35, :49], 'RGB'), (7, 5)))
+        median = resample.block_median(self.pixels, (7, 5))
+        mode = resample.block_mode(indices, (7, 5), 4)
+        row_edges, column_edges = resample.grid_edges(37, 5), resample.grid_edges(53, 7)
+        for row in range(5):
+            for column in range(7):
+                rows = slice(row_edges[row], row_edges[row + 1])
+                columns = slice(column_edges[column], column_edges[column + 1])
+                block = self.pixels[rows, columns].reshape(-1, 3)
+                even_block = self.pixels[row * 7:row * 7 + 7, column * 7:column * 7 + 7].reshape(-1, 3)
+                # PIL rounds through fixed point, which may be off by one
+                self.assertTrue(np.allclose(mean[row, column], even_block.mean(axis=0), atol=1))
+                self.assertTrue(np.array_equal(median[row, column], np.sort(block, axis=0)[(len(block) - 1) // 2]))
+                self.assertEqual(mode[row, column], np.bincount(indices[rows, columns].ravel(), minlength=4).argmax())
+
+    def test_downsampled_thumbnails(self):
+        '''Bricks covering one flat color keep it whatever the reduction'''
+        palette = palettes.get_palette('solid')
+        cells = np.random.RandomState(2).randint(0, len(palette), (6, 8))
+        image = Image.fromarray(palette.colors[cells.repeat(5, axis=0).repeat(5, axis=1)], 'RGB')
+        for downsample in ('mean', 'median', 'mode'):
+            thumbnail = lego.palette_thumbnail(image.copy(), (8, 8), 'solid', downsample=downsample)
+            self.assertEqual(thumbnail.mode, 'P')
+            self.assertTrue(np.array_equal(np.asarray(thumbnail), cells), downsample)
+        self.assertRaises(ValueError, lego.palette_thumbnail, image, (8, 8), 'solid', True, downsample='mode')
+        cutout = image.convert('RGBA')
+        cutout.putalpha(Image.fromarray(np.where(cells.repeat(5, axis=0).repeat(5, axis=1) > 3, 255, 0)
+                                        .astype(np.uint8), 'L'))
+        brick = lego.resize_brick(Image.open(BRICK_PATH), 4)
+        out_path = os.path.join(self.out_dir, 'lego.png')
+        lego.legofy_image(cutout, brick, out_path, 8, 'solid', False, alpha_threshold=128, downsample='mode')
+        with Image.open(out_path) as lego_image:
+            self.assertEqual(lego_image.size, (32, 24))
+            alpha = np.asarray(lego_image)[::4, ::4, 3]
+            self.assertTrue(np.array_equal(alpha == 255, cells > 3))
+
+    def test_cutout_edges(self):
+        '''The colors hidden under transparent pixels do not leak into the edge bricks'''
+        pixels = np.zeros((20, 20, 4), dtype=np.uint8)
+        pixels[:4, :10] = pixels[10:, 10:] = (220, 30, 30, 255)
+        cutout = Image.fromarray(pixels, 'RGBA')
+        mean = np.asarray(resample.downsample(cutout, (2, 2), 'mean'))
+        median = np.asarray(resample.downsample(cutout, (2, 2), 'median'))
+        self.assertEqual(mean[0, 0].tolist(), [220, 30, 30, 102])
+        self.assertEqual(median[0, 0].tolist(), [220, 30, 30, 255])
+        self.assertEqual(mean[1, 1].tolist(), median[1, 1].tolist())
+        self.assertEqual(median[1, 0].tolist(), [0, 0, 0, 0])
+        palette = palettes.get_palette('solid')
+        mode = lego.mode_thumbnail(cutout, (2, 2), palette)
+        red = lego.apply_thumbnail_effects(Image.new('RGB', (1, 1), (220, 30, 30)), palette).getpixel((0, 0))
+        self.assertEqual(mode.getpixel((0, 0)), red)
+
+
+class Cache(unittest.TestCase):
+    '''Test the process-wide brick cache'''
+
+    def test_lru_eviction(self):
+        '''The oldest entries go first once the memory budget is exceeded'''
+        cache = LRUCache(max_bytes=10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        cache.get('a')
+        cache.put('c', 3, 4)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.current_bytes, 8)
+
+    def test_tinted_bricks_are_reused(self):
+        '''A second render with the same palette does not tint anything'''
+        brick_cache.clear()
+        brick = lego.load_brick(BRICK_PATH)
+        thumbnail = lego.apply_thumbnail_effects(make_gradient(), lego.get_lego_palette('solid'))
+        first = lego.make_lego_image(thumbnail, brick)
+        misses = brick_cache.misses
+        second = lego.make_lego_image(thumbnail, lego.load_brick(BRICK_PATH))
+        self.assertEqual(brick_cache.misses, misses)
+        self.assertTrue(np.array_equal(np.asarray(first), np.asarray(second)))
+
+    def test_buffers_are_reused(self):
+        '''Renders of the same size borrow the band buffers released by the previous one'''
+        buffers.clear()
+        thumbnail = make_gradient()
+        first = lego.make_lego_image(thumbnail, lego.load_brick(BRICK_PATH))
+        second = lego.make_lego_image(thumbnail, lego.load_brick(BRICK_PATH))
+        self.assertEqual(buffers.stats()['allocated'], 1)
+        self.assertEqual(buffers.stats()['reused'], 1)
+        # a large render only leaves its band buffers in the pool
+        buffers.clear()
+        lego.make_lego_image(make_gradient(150, 150), lego.load_brick(BRICK_PATH))
+        self.assertLessEqual(buffers.stats()['bytes'], 3 * lego.BAND_BYTES)
+        self.assertTrue(np.array_equal(np.asarray(first), np.asarray(second)))
+        pool = BufferPool(max_bytes=100)
+        pool.release(np.empty(64, dtype=np.uint8))
+        pool.release(np.empty(64, dtype=np.uint8))
+        self.assertEqual(pool.stats()['buffers'], 1)
+        self.assertEqual(pool.borrow((64,)).nbytes, 64)
+        self.assertEqual(pool.stats()['reused'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()